@@ -10,6 +10,8 @@ import seaborn as sns
 from tqdm.notebook import tqdm
 import matplotlib.pyplot as plt
 
+import _schedule
+
 API3_PURPLE = '#7963B2'
 API3_EMERALD = '#7CE3CB'
 
@@ -59,7 +61,8 @@ def airnode_sim(df, wake_up_times, gas_price_selection='boosted'):
     if not isinstance(gas_price_selection, list):
         gas_price_selection = [gas_price_selection]
 
-    # TODO: add some lag to airnode response e.g. 1-5 seconds
+    # NOTE: lag is fixed here; for random lag (e.g. 1-5 seconds), pending txns
+    #       and many requesters, see _replay.replay
 
     def _get_recommended(df, block_num):
         # by default, recommonded gas price given by providers
@@ -68,49 +71,39 @@ def airnode_sim(df, wake_up_times, gas_price_selection='boosted'):
         df_slice = df[df['blockNum'].isin(prev20)]
         return np.percentile(df_slice['gasPrice'], 60)
 
-    # queue of block numbers
-    block_queue = list(df['blockNum'].unique())
-    block_queue.sort() # just in case
-
     # dataframe containing only min gas price per block
     df_min = df.groupby('blockNum').min()[['gasPrice', 'timeStamp']]
     df_max = df.groupby('blockNum').max()[['gasPrice', 'timeStamp']]
 
     ### 1. Airnode wakes up
-    prev = block_queue.pop(0)
-    for i,ts in tqdm(list(enumerate((wake_up_times)))):
+    ### 2. Checks most recently mined block
+    # add lag: 3 seconds, pretty conservative
+    # all wake-ups are aligned with blocks up front, see _schedule.resolve
+    wake_ups = _schedule.resolve(wake_up_times, df_min['timeStamp'], lag=3, window=60, delay=10)
+    block_nums = df_min.index.to_numpy()
 
-        # add lag: 3 seconds, pretty conservative
-        ts += 3
+    for row in tqdm(wake_ups.itertuples(), total=len(wake_ups)):
 
-        ### 2. Checks most recently mined block
-        curr = block_queue.pop(0)
+        ts = row.ts
 
-        # ensure: current_block.ts <= ts < next_block.ts
-        while df_min.loc[curr].timeStamp <= ts:
-            prev = curr
-            curr = block_queue.pop(0)
+        # current_block.ts <= ts < next_block.ts
+        current_block = row.current_block
+        next_block = row.next_block
 
-        current_block = prev
-        next_block = curr
-
-        ts1 = df_min.loc[current_block].timeStamp
         ts2 = df_min.loc[next_block].timeStamp
 
-        assert ts1 <= ts < ts2
-
         if ts2 - ts > 60:
-            for method, chosen_gas_price in zip(gas_price_selection, chosen_gas_prices):
-                # next block is 60 seconds after `ts`
-                # our transaction woulnd't get mined regardless
+            # next block is 60 seconds after `ts`
+            # our transaction woulnd't get mined regardless
+            for method in gas_price_selection:
                 result['wakeup_ts'].append(ts)
                 result['method'].append(method)
                 result['gasPrice'].append(None)
                 #result['mined?'].append(False)
                 result['confirmation_block_num'].append(None)
                 result['confirmation_block_seconds'].append(None)
-                result['next_block_percentiles'].append(ps)
-                continue
+                result['next_block_percentiles'].append(None)
+            continue
 
         chosen_gas_prices = []
 
@@ -152,16 +145,9 @@ def airnode_sim(df, wake_up_times, gas_price_selection='boosted'):
         # Is this gas price *strictly greater* than the min gas price
         # in all blocks mined in the next minute??
 
-        # get all blocks mined within the minute
-        # NOTE: don't pop!
-        nxt_blocks = [next_block]
-        j = 0
-        while df_min.loc[block_queue[j]].timeStamp <= ts + 60:
-            nxt_blocks.append(block_queue[j])
-            j += 1
-
-        # don't include blocks that are currently being mined
-        nxt_blocks = [b for b in nxt_blocks if df_min.loc[b].timeStamp > 10 + ts]
+        # all blocks mined within the minute,
+        # except blocks that are currently being mined
+        nxt_blocks = block_nums[row.window_lo:row.window_hi]
 
         for i,b in enumerate(nxt_blocks):
 
@@ -0,0 +1,219 @@
+"""
+Event-driven replay of simulated Airnode transactions against block history.
+
+Blocks are stepped through once, in order. Simulated txns enter a pending
+pool once they've propagated and leave it when a block includes them (their
+gas price is strictly greater than the block's minimum gas price) or when they
+time out, so the cost is linear in blocks plus txns (with a log factor for
+the pool's heaps) instead of one scan of the data per wake-up:
+
+    blocks = block_table(df)
+    strategies = {
+        'recommended': recommended_strategy(df),
+        'boosted_1.5': recommended_strategy(df, boost=1.5),
+    }
+    wake_up_times = np.concatenate([
+        _schedule.jittered_schedule('2020-01-01', '2021-01-01', seed=i) for i in range(10)])
+    df_txns, df_blocks = replay(blocks, wake_up_times, strategies, lag=(1, 5), seed=0)
+
+Only blocks in `blocks` are replayed; scrape with `--sampling all` for a
+faithful replay, since sampled out blocks can't include anything.
+"""
+
+import heapq
+
+import numpy as np
+import pandas as pd
+
+
+def block_table(df):
+    """
+    Per block timestamp and minimum gas price, from txns (blockNum, gasPrice, timeStamp).
+    """
+    g = df.groupby('blockNum')
+    return pd.DataFrame({
+        'timeStamp': g['timeStamp'].min(),
+        'minGasPrice': g['gasPrice'].min(),
+    }).sort_index()
+
+
+def recommended_strategy(df, boost=1.0, window=20, percentile=60):
+    """
+    Gas price strategy: `boost` times the `percentile`th percentile of gas
+    prices in the `window` blocks before the current block (what providers
+    recommend by default).
+
+    Returns a function mapping current block numbers to gas prices; each
+    distinct block is only computed once.
+    """
+    df = df.sort_values('blockNum', kind='stable')
+    txn_blocks = df['blockNum'].to_numpy()
+    gas_prices = df['gasPrice'].to_numpy()
+
+    def strategy(current_blocks):
+        blocks, inverse = np.unique(current_blocks, return_inverse=True)
+        # txns are sorted by block, so the previous `window` blocks are one slice
+        lo = np.searchsorted(txn_blocks, blocks - window, side='left')
+        hi = np.searchsorted(txn_blocks, blocks, side='left')
+        prices = np.array([
+            np.percentile(gas_prices[a:b], percentile) if b > a else np.nan
+            for a, b in zip(lo, hi)
+        ])
+        return boost * prices[inverse]
+
+    return strategy
+
+
+def _sample(spec, rng, n):
+    """
+    `n` draws of a delay spec: a number (constant), a (low, high) tuple
+    (uniform) or a function of (rng, n).
+    """
+    if callable(spec):
+        return np.asarray(spec(rng, n), dtype='float64')
+    if isinstance(spec, tuple):
+        return rng.uniform(spec[0], spec[1], n)
+    return np.full(n, float(spec))
+
+
+def replay(blocks, wake_up_times, strategies, lag=3, delay=10, timeout=60,
+           requesters=None, capacity=None, seed=None):
+    """
+    Replay one simulated txn per wake-up and strategy.
+
+    - blocks: DataFrame indexed by block number with timeStamp and
+      minGasPrice columns (see `block_table`)
+    - wake_up_times: unix timestamps, in any order; concatenate schedules
+      to simulate many requesters, and pass their ids as `requesters`
+    - strategies: dict of name -> function mapping the most recent block
+      at submission to a gas price (see `recommended_strategy`)
+    - lag: Airnode response time, i.e. seconds from wake-up to submission
+    - delay: seconds until a submitted txn can be included; blocks mined
+      before then were already in the making
+    - timeout: seconds after submission after which the txn is given up on
+    - capacity: max number of simulated txns per block (highest prices
+      first), or None for no limit
+
+    `lag` and `delay` can be constants, (low, high) for uniformly random
+    values, or functions of (rng, n) returning n values.
+
+    Wake-ups that would time out after the last block are dropped. Txns
+    a strategy can't price (NaN, e.g. no txns in the blocks before) are
+    never submitted, and reported as not mined.
+    Returns two DataFrames:
+    - one row per simulated txn, with the block that included it (if any)
+    - one row per block, with the number of pending and included txns
+    """
+    rng = np.random.default_rng(seed)
+    names = list(strategies)
+
+    block_nums = blocks.index.to_numpy()
+    block_ts = blocks['timeStamp'].to_numpy()
+    min_prices = blocks['minGasPrice'].to_numpy()
+
+    wake_up_times = np.asarray(wake_up_times, dtype='float64')
+    if requesters is None:
+        requesters = np.zeros(len(wake_up_times), dtype='int64')
+    requesters = np.asarray(requesters)
+
+    ##
+    ## schedule submissions
+    ##
+
+    submit_ts = wake_up_times + _sample(lag, rng, len(wake_up_times))
+    # most recently mined block at submission
+    current = np.searchsorted(block_ts, submit_ts, side='right') - 1
+    valid = (current >= 0) & (submit_ts + timeout <= block_ts[-1])
+    wake_up_times, submit_ts, current, requesters = (
+        wake_up_times[valid], submit_ts[valid], current[valid], requesters[valid])
+
+    # one txn per wake-up and strategy
+    n = len(submit_ts) * len(names)
+    method = np.repeat(np.arange(len(names)), len(submit_ts))
+    wake = np.tile(np.arange(len(submit_ts)), len(names))
+    gas_price = np.concatenate([
+        np.asarray(strategies[name](block_nums[current]), dtype='float64') for name in names
+    ]) if names else np.zeros(0)
+    eligible_ts = submit_ts[wake] + _sample(delay, rng, n)
+    deadline = submit_ts[wake] + timeout
+
+    ##
+    ## replay blocks
+    ##
+
+    order = np.argsort(eligible_ts, kind='stable')
+    included = np.full(n, -1, dtype='int64')
+    first_block = np.full(n, -1, dtype='int64')
+    done = np.zeros(n, dtype=bool)
+
+    n_pending = np.zeros(len(block_ts), dtype='int64')
+    n_included = np.zeros(len(block_ts), dtype='int64')
+
+    # highest price first; txns that timed out are skipped when popped
+    by_price = []
+    by_deadline = []
+    pending = 0
+    j = 0
+
+    for b, t in enumerate(block_ts):
+        # txns that have propagated by this block
+        while j < n and eligible_ts[order[j]] < t:
+            k = order[j]
+            j += 1
+            if not np.isfinite(gas_price[k]):
+                # unpriced; would break the heap's ordering
+                continue
+            heapq.heappush(by_price, (-gas_price[k], k))
+            heapq.heappush(by_deadline, (deadline[k], k))
+            first_block[k] = b
+            pending += 1
+
+        # give up on txns past their deadline
+        while by_deadline and by_deadline[0][0] < t:
+            _, k = heapq.heappop(by_deadline)
+            if not done[k]:
+                done[k] = True
+                pending -= 1
+
+        # include every pending txn priced above the block's minimum
+        count = 0
+        while by_price and -by_price[0][0] > min_prices[b] and (capacity is None or count < capacity):
+            _, k = heapq.heappop(by_price)
+            if done[k]:
+                continue
+            included[k] = b
+            done[k] = True
+            pending -= 1
+            count += 1
+
+        n_pending[b] = pending
+        n_included[b] = count
+
+    ##
+    ## results
+    ##
+
+    mined = included >= 0
+    df_txns = pd.DataFrame({
+        'requester': requesters[wake],
+        'method': np.array(names, dtype=object)[method] if names else np.zeros(0, dtype=object),
+        'wakeup_ts': wake_up_times[wake],
+        'submit_ts': submit_ts[wake],
+        'current_block': block_nums[current[wake]],
+        'gasPrice': gas_price,
+        'mined?': mined,
+        'confirmation_block': pd.array(np.where(mined, block_nums[included], 0), dtype='Int64'),
+        # number of blocks since the txn could first be included (1 = first block)
+        'confirmation_block_num': pd.array(included - first_block + 1, dtype='Int64'),
+        'confirmation_block_seconds': np.where(mined, block_ts[included] - submit_ts[wake], np.nan),
+    })
+    df_txns.loc[~mined, ['confirmation_block', 'confirmation_block_num']] = pd.NA
+
+    df_blocks = pd.DataFrame({
+        'timeStamp': block_ts,
+        'minGasPrice': min_prices,
+        'pending': n_pending,
+        'included': n_included,
+    }, index=pd.Index(block_nums, name='blockNum'))
+
+    return df_txns, df_blocks
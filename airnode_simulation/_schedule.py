@@ -0,0 +1,105 @@
+"""Airnode wake-up schedules and their alignment with block timestamps"""
+
+import numpy as np
+import pandas as pd
+
+
+def _to_unixtime(t):
+    if isinstance(t, (int, float, np.integer, np.floating)):
+        return float(t)
+    return pd.Timestamp(t, tz='utc').timestamp()
+
+
+def fixed_schedule(start, end, cadence=60):
+    """
+    Wake up every `cadence` seconds in [start, end).
+    `start`/`end` are unix timestamps or anything `pd.Timestamp` understands (UTC).
+    """
+    return np.arange(_to_unixtime(start), _to_unixtime(end), cadence).astype('int64')
+
+
+def jittered_schedule(start, end, cadence=60, jitter=10, seed=None):
+    """
+    Fixed cadence, with each wake-up shifted uniformly by up to +/- `jitter` seconds.
+    """
+    rng = np.random.default_rng(seed)
+    wake_up_times = fixed_schedule(start, end, cadence)
+    wake_up_times = wake_up_times + rng.integers(-jitter, jitter + 1, len(wake_up_times))
+    wake_up_times.sort()
+    return wake_up_times
+
+
+def poisson_schedule(start, end, mean_interval=60, seed=None):
+    """
+    Wake-ups as a Poisson process with `mean_interval` seconds between them on average.
+    """
+    rng = np.random.default_rng(seed)
+    start, end = _to_unixtime(start), _to_unixtime(end)
+    # draw a few more gaps than needed on average, then top up if we fell short
+    n = int((end - start) / mean_interval * 1.1) + 10
+    ts = start + np.cumsum(rng.exponential(mean_interval, n))
+    while ts[-1] < end:
+        ts = np.concatenate([ts, ts[-1] + np.cumsum(rng.exponential(mean_interval, n))])
+    return ts[ts < end].astype('int64')
+
+
+def resolve(wake_up_times, blocks, lag=3, window=60, delay=10):
+    """
+    Align wake-ups with blocks in one vectorized pass.
+
+    `blocks` is a Series of block timestamps indexed by block number
+    (e.g. `df.groupby('blockNum').timeStamp.min()`), sorted by block number.
+
+    For each wake-up at `t` (the Airnode responds at `ts = t + lag`):
+    - current_block: most recently mined block, i.e. timestamp <= ts
+    - next_block: first block mined after ts
+    - window_lo/window_hi: positions in `blocks` of the confirmation window, i.e.
+      blocks mined in (ts + delay, ts + window]; blocks mined within `delay`
+      seconds of ts are considered to be already in the making
+
+    Wake-ups before the first or after the last known block are dropped.
+    Returns a DataFrame with one row per remaining wake-up.
+    """
+    block_nums = blocks.index.to_numpy()
+    block_ts = blocks.to_numpy()
+
+    ts = np.asarray(wake_up_times, dtype='int64') + lag
+
+    cur = np.searchsorted(block_ts, ts, side='right') - 1
+    lo = np.searchsorted(block_ts, ts + delay, side='right')
+    hi = np.searchsorted(block_ts, ts + window, side='right')
+
+    valid = (cur >= 0) & (cur + 1 < len(block_ts))
+    ts, cur, lo, hi = ts[valid], cur[valid], lo[valid], hi[valid]
+
+    return pd.DataFrame({
+        'wakeup_ts': ts - lag,
+        'ts': ts,
+        'current_block': block_nums[cur],
+        'next_block': block_nums[cur + 1],
+        'window_lo': lo,
+        'window_hi': np.maximum(lo, hi),
+    })
+
+
+def explode_windows(resolved, blocks):
+    """
+    Long format of the confirmation windows of `resolve`: one row per
+    (wake-up, block in its window), with the block's position in the window
+    (1 = first block) and seconds since the wake-up response.
+    """
+    block_nums = blocks.index.to_numpy()
+    block_ts = blocks.to_numpy()
+
+    counts = (resolved['window_hi'] - resolved['window_lo']).to_numpy()
+    row = np.repeat(np.arange(len(resolved)), counts)
+    # position of each block inside its own window
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pos = resolved['window_lo'].to_numpy()[row] + offset
+
+    return pd.DataFrame({
+        'wakeup': resolved.index.to_numpy()[row],
+        'blockNum': block_nums[pos],
+        'confirmation_block_num': offset + 1,
+        'confirmation_block_seconds': block_ts[pos] - resolved['ts'].to_numpy()[row],
+    })
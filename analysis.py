@@ -0,0 +1,182 @@
+'''
+Out-of-core analysis of the scraped dataset.
+
+Instead of `pd.concat`-ing every part into one frame, aggregations are
+fed block-ordered chunks (see `dataset.iter_ordered_chunks`) one at a
+time, so memory stays bounded at any sampling rate or date range:
+
+    results = analysis.run(dataset.find_parts('data/gas_prices_*'), {
+        'count': analysis.Count(),
+        'blocks': analysis.BlockSummary(),
+        'quantiles': analysis.Quantiles(),
+        'sketches': analysis.BlockSketches(),
+    })
+    results['quantiles'].percentile([10, 50, 90])
+
+Aggregations are mergeable, so `run_parallel` splits the dataset into
+block ranges, aggregates them in separate processes and merges the results.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import copy
+
+import pandas as pd
+
+import dataset
+from sketch import DEFAULT_RELATIVE_ACCURACY, QuantileSketch, SketchTable
+
+DEFAULT_PERCENTILES = (0, 10, 25, 50, 75, 90, 100)
+
+
+class Count(object):
+    '''Number of txns and blocks.'''
+
+    def __init__(self):
+        self.txns = 0
+        self.blocks = 0
+
+    def update(self, chunk):
+        self.txns += len(chunk)
+        # blocks are never split across chunks
+        self.blocks += chunk['blockNum'].nunique()
+
+    def merge(self, other):
+        self.txns += other.txns
+        self.blocks += other.blocks
+        return self
+
+    def result(self):
+        return {'txns': self.txns, 'blocks': self.blocks}
+
+
+class BlockSummary(object):
+    '''
+    Per block: number of txns, min, max, mean and percentiles of the gas price.
+    The result has one row per block, which is small even for the full history.
+    '''
+
+    def __init__(self, percentiles=DEFAULT_PERCENTILES, column='gasPrice'):
+        self.percentiles = tuple(percentiles)
+        self.column = column
+        self.parts = []
+
+    def update(self, chunk):
+        g = chunk.groupby('blockNum')[self.column]
+        df = g.agg(['count', 'min', 'max', 'mean'])
+        if self.percentiles:
+            q = g.quantile([p / 100 for p in self.percentiles]).unstack()
+            q.columns = [f'p{p}' for p in self.percentiles]
+            df = df.join(q)
+        self.parts.append(df)
+
+    def merge(self, other):
+        self.parts.extend(other.parts)
+        return self
+
+    def result(self):
+        if not self.parts:
+            return pd.DataFrame()
+        return pd.concat(self.parts).sort_index()
+
+
+class Quantiles(object):
+    '''Approximate quantiles of a column over the whole dataset (see sketch.py).'''
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, column='gasPrice'):
+        self.column = column
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def update(self, chunk):
+        self.sketch.add(chunk[self.column].to_numpy())
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        return self
+
+    def result(self):
+        return self.sketch
+
+
+class BlockSketches(object):
+    '''
+    Per block quantile sketches (a `sketch.SketchTable`), e.g. to replace
+    raw parts that were scraped before `scrape.py --sketches` existed.
+    '''
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, column='gasPrice'):
+        self.relative_accuracy = relative_accuracy
+        self.column = column
+        self.parts = []
+
+    def update(self, chunk):
+        self.parts.append(SketchTable.from_frame(chunk, self.relative_accuracy, column=self.column))
+
+    def merge(self, other):
+        self.parts.extend(other.parts)
+        return self
+
+    def result(self):
+        return SketchTable.concat(self.parts) if self.parts else SketchTable.empty(self.relative_accuracy)
+
+
+def run(paths, aggregations, chunksize=dataset.CHUNKSIZE, index=None):
+    '''
+    Feed every chunk of the part files in `paths` to each of the `aggregations`
+    (a dict of name -> aggregation) in one pass, and return their results.
+    '''
+    _aggregate(paths, aggregations, chunksize, index)
+    return {name: a.result() for name, a in aggregations.items()}
+
+
+def _aggregate(paths, aggregations, chunksize=dataset.CHUNKSIZE, index=None):
+    for chunk in dataset.iter_ordered_chunks(paths, chunksize, index=index):
+        for a in aggregations.values():
+            a.update(chunk)
+    return aggregations
+
+
+def split_index(index, n):
+    '''
+    Split a file index (see `dataset.build_index`) into up to `n` groups of
+    files covering disjoint block ranges, with about the same number of rows.
+    '''
+    # files can only be separated where no earlier file reaches past the next one's first block
+    reach = index['maxBlock'].cummax().shift(fill_value=-1)
+    can_cut = (index['minBlock'] > reach).to_numpy()
+    rows = index['rows'].cumsum().to_numpy()
+    target = rows[-1] / n if len(rows) else 0
+
+    groups = []
+    start = 0
+    for i in range(1, len(index)):
+        if can_cut[i] and rows[i - 1] - (rows[start - 1] if start else 0) >= target:
+            groups.append(index.iloc[start:i])
+            start = i
+    groups.append(index.iloc[start:])
+    return [g for g in groups if len(g)]
+
+
+def run_parallel(paths, aggregations, processes=None, chunksize=dataset.CHUNKSIZE, index=None):
+    '''
+    Like `run`, with block ranges aggregated in `processes` worker processes.
+    '''
+    if index is None:
+        index = dataset.build_index(paths)
+    groups = split_index(index, processes or 1)
+
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [
+            pool.submit(_aggregate, g['path'].tolist(), copy.deepcopy(aggregations), chunksize, g)
+            for g in groups
+        ]
+        # merge in block order
+        merged = None
+        for f in futures:
+            result = f.result()
+            if merged is None:
+                merged = result
+            else:
+                for name, a in merged.items():
+                    a.merge(result[name])
+
+    merged = merged or aggregations
+    return {name: a.result() for name, a in merged.items()}
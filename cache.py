@@ -0,0 +1,230 @@
+'''
+Persistent cache of JSON-RPC responses, shared by all scraper threads.
+
+shelve isn't thread-safe, so every access goes through a lock.
+Only calls whose results never change are cached (blocks by number/hash,
+txns by hash), and only successful, non-empty responses.
+
+Blocks near the head of the chain can still be reorged, so responses are
+only stored on disk once their block is `finality_depth` blocks deep.
+Until then they're kept in memory for `recent_ttl` seconds, and dropped
+early when a block comes in whose hash (or its child's parentHash) shows
+the block they came from is no longer on the chain.
+'''
+import json
+import logging
+import shelve
+import threading
+import time
+
+from config import FINALITY_DEPTH, RECENT_CACHE_TTL
+
+CACHED_METHODS = {
+    'eth_getBlockByHash',
+    'eth_getBlockByNumber',
+    'eth_getTransactionByHash',
+    'eth_getTransactionByBlockHashAndIndex',
+    'eth_getTransactionByBlockNumberAndIndex',
+    'eth_getTransactionReceipt',
+    'eth_getBlockReceipts',
+}
+
+BLOCK_METHODS = {'eth_getBlockByHash', 'eth_getBlockByNumber'}
+
+
+def _default(o):
+    if isinstance(o, (bytes, bytearray)):
+        return '0x' + bytes(o).hex()
+    return str(o)
+
+
+def _int(x):
+    if x is None:
+        return None
+    if isinstance(x, str):
+        return int(x, 16)
+    return int(x)
+
+
+def _hash(x):
+    if x is None:
+        return None
+    if isinstance(x, (bytes, bytearray)):
+        return '0x' + bytes(x).hex()
+    return str(x).lower()
+
+
+def cache_key(method, params):
+    return f"{method}:{json.dumps(params, default=_default, sort_keys=True)}"
+
+
+def should_cache(method, params, response):
+    if method not in CACHED_METHODS:
+        return False
+    if 'error' in response or response.get('result') is None:
+        return False
+    # blocks can't be looked up by tag, e.g. 'latest'
+    if method == 'eth_getBlockByNumber' and params and params[0] in ('latest', 'pending', 'earliest', 'safe', 'finalized'):
+        return False
+    return True
+
+
+def response_block(method, params, result):
+    '''
+    Number and hash of the block a cacheable result belongs to
+    (None for the number of pending txns).
+    '''
+    if method in BLOCK_METHODS:
+        return _int(result['number']), _hash(result['hash'])
+    if method == 'eth_getBlockReceipts':
+        if not result:
+            return _int(params[0]), None
+        result = result[0]
+    return _int(result.get('blockNumber')), _hash(result.get('blockHash'))
+
+
+class RPCCache(object):
+
+    def __init__(self, path, finality_depth=FINALITY_DEPTH, recent_ttl=RECENT_CACHE_TTL):
+        self.path = path
+        self.db = shelve.open(path, 'c')
+        self.lock = threading.Lock()
+
+        self.finality_depth = finality_depth
+        self.recent_ttl = recent_ttl
+        # key -> (expiry time, block number, block hash, response) of non-final blocks
+        self.recent = {}
+        # block number -> hash, for recent blocks we've seen
+        self.block_hashes = {}
+        self.head = None
+        self.head_time = 0
+
+    def get(self, key):
+        with self.lock:
+            return self.db.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.db[key] = value
+
+    def get_recent(self, key):
+        '''Response of a non-final block, if it's fresh and its block is still canonical.'''
+        with self.lock:
+            entry = self.recent.get(key)
+            if entry is None:
+                return None
+            expiry, number, block_hash, response = entry
+            canonical = self.block_hashes.get(number)
+            if expiry < time.time() or (block_hash and canonical and canonical != block_hash):
+                del self.recent[key]
+                return None
+            return response
+
+    def set_recent(self, key, response, number, block_hash):
+        with self.lock:
+            self.recent[key] = (time.time() + self.recent_ttl, number, block_hash, response)
+
+    def observe_head(self, number):
+        with self.lock:
+            self.head = max(self.head or 0, number)
+            self.head_time = time.time()
+
+    def head_is_stale(self):
+        with self.lock:
+            return self.head is None or time.time() - self.head_time > self.recent_ttl
+
+    def is_final(self, number):
+        with self.lock:
+            return self.head is not None and self.head - number >= self.finality_depth
+
+    def observe_block(self, number, block_hash, parent_hash):
+        '''
+        Record a block's hash and its parent's; a mismatch with what we've seen
+        before means a reorg, and recent responses from there on are dropped.
+        '''
+        with self.lock:
+            for n, h in [(number - 1, parent_hash), (number, block_hash)]:
+                if h is None:
+                    continue
+                known = self.block_hashes.get(n)
+                if known is not None and known != h:
+                    logging.warning(f"Reorg at block {n}: {known} replaced by {h}.")
+                    self._invalidate_from(n)
+                self.block_hashes[n] = h
+
+            if self.head is not None:
+                # hashes of final blocks aren't needed anymore
+                oldest = self.head - self.finality_depth
+                for n in [n for n in self.block_hashes if n < oldest]:
+                    del self.block_hashes[n]
+            if number > (self.head or 0):
+                self.head = number
+
+    def _invalidate_from(self, number):
+        for n in [n for n in self.block_hashes if n >= number]:
+            del self.block_hashes[n]
+        for key in [k for k, entry in self.recent.items() if entry[1] >= number]:
+            del self.recent[key]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+def open_cache(path):
+    '''Return the cache stored at `path`, shared by all callers in this process.'''
+    with _CACHES_LOCK:
+        if path not in _CACHES:
+            _CACHES[path] = RPCCache(path)
+        return _CACHES[path]
+
+
+def construct_cache_middleware(cache):
+    '''
+    web3 middleware answering cacheable calls from `cache`.
+    '''
+    def cache_middleware(make_request, web3):
+        def middleware(method, params):
+            if method == 'eth_blockNumber':
+                response = make_request(method, params)
+                if response.get('result') is not None:
+                    cache.observe_head(_int(response['result']))
+                return response
+
+            if method not in CACHED_METHODS:
+                return make_request(method, params)
+
+            key = cache_key(method, params)
+            response = cache.get(key)
+            if response is None:
+                response = cache.get_recent(key)
+            if response is not None:
+                return response
+
+            response = make_request(method, params)
+            if not should_cache(method, params, response):
+                return response
+
+            result = response['result']
+            number, block_hash = response_block(method, params, result)
+            if number is None:
+                # pending txn
+                return response
+            if method in BLOCK_METHODS:
+                cache.observe_block(number, block_hash, _hash(result.get('parentHash')))
+
+            if cache.head_is_stale():
+                head = make_request('eth_blockNumber', [])
+                if head.get('result') is not None:
+                    cache.observe_head(_int(head['result']))
+
+            if cache.is_final(number):
+                cache.set(key, response)
+            else:
+                cache.set_recent(key, response, number, block_hash)
+            return response
+        return middleware
+    return cache_middleware
@@ -1,5 +1,4 @@
 import json
-import multiprocessing
 import os
 
 INFURA_API_KEY = os.getenv('INFURA_API_KEY')
@@ -8,5 +7,28 @@ NODE_IP_ADDR = os.getenv('NODE_IP_ADDR')
 
 # configs for scraping transaction prices
 SAMPLE_PERCENT = 5
-NTHREADS = multiprocessing.cpu_count() - 1
+# producer + consumers; None: one consumer per request the endpoints'
+# adaptive concurrency limits allow in flight (see ratelimit.py)
+NTHREADS = None
 TIMEZONE = 'utc'
+
+# per-endpoint limits for JSON-RPC calls (see ratelimit.py)
+RPC_REQUESTS_PER_SECOND = 100
+RPC_MAX_CONCURRENCY = 64
+RPC_MAX_RETRIES = 5
+# how often a failed txn lookup is put back on the queue before giving up
+MAX_REQUEUES = 3
+
+# blocks this deep are considered final (safe from reorgs); responses for
+# newer blocks are only cached in memory, for this many seconds (see cache.py)
+FINALITY_DEPTH = 64
+RECENT_CACHE_TTL = 30
+
+# scraper output
+BLOCKS_PER_PART = 50
+TXNS_PER_BLOCK = 170 # approximation, for progress and planning
+RPC_LATENCY = 0.05 # seconds, rough round trip time used for planning
+# relative error of quantile sketches (see sketch.py)
+SKETCH_RELATIVE_ACCURACY = 0.01
+# blocks per JSON-RPC batch in raw mode (see rawrpc.py)
+RAW_BATCH_SIZE = 20
@@ -0,0 +1,242 @@
+'''
+Reading the scraped dataset.
+
+`scrape.py` writes two kinds of tab-separated files:
+
+- parts: `gas_prices_<from>_<to>_<n>%-sampling_<part>.csv`
+  with columns blockNum, txnID, gasPrice
+  (or `.parquet` files with the same columns, see `scrape.py --format`);
+  with `scrape.py --fees` also effectiveGasPrice, priorityFee, baseFee, gasUsed
+- block tables: `blocks_gas_prices_<from>_<to>_<n>%-sampling.csv`
+  with columns blockNum, timeStamp, txnCount
+
+(`_<to>` is left out of the names of scrapes without an end, see
+`scrape.default_name`.)
+
+and, with `scrape.py --sketches` or `--format sketch`, per block gas price
+sketches `gas_prices_<...>_<part>.sketch.npz` (see sketch.SketchTable).
+
+Everything here streams over parts in chunks so memory stays bounded
+no matter how much history there is.
+'''
+import glob
+import json
+import logging
+import math
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+PART_PATTERN = ['gas_prices_*.csv', 'gas_prices_*.parquet']
+BLOCKS_PATTERN = 'blocks_gas_prices_*.csv'
+SKETCH_PATTERN = 'gas_prices_*.sketch.npz'
+
+# rows per chunk when streaming over parts
+CHUNKSIZE = 1_000_000
+
+PART_DTYPES = {
+    'blockNum': 'int64',
+    'txnID': 'object',
+    'gasPrice': 'int64',
+    # only in parts scraped with --fees
+    'effectiveGasPrice': 'int64',
+    'priorityFee': 'int64',
+    'baseFee': 'int64',
+    'gasUsed': 'int64',
+}
+
+
+def find_files(patterns):
+    '''
+    Expand glob `patterns` (a string or list of strings) into a sorted list of paths.
+    Numbers sort numerically, so part `_10` comes after part `_2`.
+    '''
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    paths = set()
+    for p in patterns:
+        paths.update(glob.glob(p))
+    return sorted(paths, key=_natural_key)
+
+
+def _natural_key(path):
+    return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', path)]
+
+
+def find_parts(patterns=PART_PATTERN):
+    '''Paths of all part files matching `patterns`, without block tables.'''
+    return [p for p in find_files(patterns) if not _is_blocks_file(p)]
+
+
+def _is_blocks_file(path):
+    return path.rsplit('/', 1)[-1].startswith('blocks_')
+
+
+def iter_chunks(paths, chunksize=CHUNKSIZE, usecols=None):
+    '''
+    Yield DataFrames of at most `chunksize` rows from the part files in `paths`.
+    '''
+    for path in paths:
+        if path.endswith('.parquet'):
+            yield from _iter_parquet(path, chunksize, usecols)
+            continue
+        reader = pd.read_csv(
+            path, delimiter='\t', chunksize=chunksize, usecols=usecols,
+            dtype={k: v for k, v in PART_DTYPES.items() if not usecols or k in usecols},
+        )
+        for chunk in reader:
+            yield chunk
+
+
+def _iter_parquet(path, chunksize, usecols=None):
+    # requires pyarrow
+    import pyarrow.parquet as pq
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=usecols):
+        yield batch.to_pandas()
+
+
+def build_index(paths, index_path=None):
+    '''
+    One row per part file: path, size, mtime, rows, minBlock, maxBlock.
+
+    With `index_path`, entries are kept in a JSON file and only files
+    that are new or changed since are read again.
+    '''
+    cached = {}
+    if index_path and os.path.exists(index_path):
+        with open(index_path) as f:
+            cached = json.load(f)
+
+    entries = {}
+    for path in paths:
+        stat = os.stat(path)
+        entry = cached.get(path)
+        if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            rows, lo, hi = 0, math.inf, -math.inf
+            for chunk in iter_chunks([path], usecols=['blockNum']):
+                rows += len(chunk)
+                if len(chunk):
+                    lo, hi = min(lo, int(chunk['blockNum'].min())), max(hi, int(chunk['blockNum'].max()))
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'rows': rows, 'minBlock': lo, 'maxBlock': hi}
+        entries[path] = entry
+
+    if index_path:
+        with open(index_path, 'w') as f:
+            json.dump({**cached, **entries}, f)
+
+    index = pd.DataFrame.from_dict(entries, orient='index', columns=['size', 'mtime', 'rows', 'minBlock', 'maxBlock'])
+    index.index.name = 'path'
+    # empty files don't matter for ordering
+    index = index[index['rows'] > 0].astype({'minBlock': 'int64', 'maxBlock': 'int64'})
+    return index.reset_index().sort_values(['minBlock', 'path'], ignore_index=True)
+
+
+def fingerprint(paths):
+    '''
+    A hex digest of the part files in `paths` (names, sizes and mtimes)
+    that changes whenever the data does. Files aren't read, so it's
+    cheap enough to compute on every run.
+    '''
+    import hashlib
+    entries = sorted(
+        (os.path.basename(path), stat.st_size, stat.st_mtime_ns)
+        for path, stat in ((path, os.stat(path)) for path in paths)
+    )
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+
+def iter_ordered_chunks(paths, chunksize=CHUNKSIZE, usecols=None, index=None, dedup=True):
+    '''
+    Yield chunks of txns sorted by blockNum across all part files in `paths`,
+    even if they come from several (overlapping) scrapes. No block is split
+    across chunks, and with `dedup` txns that are in several files are only
+    yielded once (by blockNum and txnID, which is read for that even if
+    it isn't in `usecols`).
+
+    Memory holds about one chunk plus the rows of files whose block
+    ranges overlap, which for scrape.py output is a part or two.
+    '''
+    if index is None:
+        index = build_index(paths)
+    extra = []
+    if dedup and usecols is not None:
+        extra = [c for c in ['blockNum', 'txnID'] if c not in usecols]
+        usecols = list(usecols) + extra
+    min_blocks = index['minBlock'].tolist() + [math.inf]
+
+    pending = None
+    out = []
+    out_rows = 0
+    for i, path in enumerate(index['path']):
+        chunks = list(iter_chunks([path], chunksize, usecols))
+        if pending is not None:
+            chunks.insert(0, pending)
+        pending = pd.concat(chunks, ignore_index=True)
+
+        # no file still to be read has txns of blocks before the next file's first block
+        done = pending['blockNum'] < min_blocks[i + 1]
+        ready = pending[done]
+        pending = pending[~done]
+
+        if len(ready):
+            out.append(ready)
+            out_rows += len(ready)
+        if out_rows >= chunksize or (i == len(index) - 1 and out_rows):
+            df = pd.concat(out, ignore_index=True).sort_values('blockNum', kind='stable', ignore_index=True)
+            if dedup:
+                df = df.drop_duplicates(subset=['blockNum', 'txnID'], ignore_index=True).drop(columns=extra)
+            yield from _split_blocks(df, chunksize)
+            out, out_rows = [], 0
+
+
+def _split_blocks(df, chunksize):
+    '''Split a block-sorted frame into chunks of about `chunksize` rows, at block boundaries.'''
+    blocks = df['blockNum'].to_numpy()
+    cuts = np.unique(np.searchsorted(blocks, blocks[chunksize::chunksize], side='left'))
+    start = 0
+    for cut in list(cuts[cuts > 0]) + [len(df)]:
+        if cut > start:
+            yield df.iloc[start:cut]
+        start = cut
+
+
+def load_block_timestamps(patterns=BLOCKS_PATTERN):
+    '''
+    Return a Series mapping blockNum -> unix timestamp, from all block tables.
+    '''
+    dfs = [
+        pd.read_csv(path, delimiter='\t', dtype={'blockNum': 'int64', 'timeStamp': 'int64'})
+        for path in find_files(patterns)
+    ]
+    if not dfs:
+        logging.warning(f"No block tables found for {patterns}.")
+        return pd.Series([], dtype='int64', name='timeStamp')
+    df = pd.concat(dfs, ignore_index=True).drop_duplicates('blockNum')
+    return df.set_index('blockNum')['timeStamp'].sort_index()
+
+
+def load_sketches(patterns=SKETCH_PATTERN):
+    '''
+    Return a `sketch.SketchTable` of all per block sketches, merging blocks
+    that were split over several parts.
+    '''
+    from sketch import SketchTable
+    paths = find_files(patterns)
+    if not paths:
+        logging.warning(f"No sketches found for {patterns}.")
+    return SketchTable.concat([SketchTable.load(p) for p in paths])
+
+
+def add_timestamps(df, block_timestamps):
+    '''
+    Add a `timeStamp` column to `df` using the blockNum -> timestamp map.
+    Rows of blocks without a known timestamp are dropped.
+    '''
+    df = df.assign(timeStamp=df['blockNum'].map(block_timestamps))
+    missing = df['timeStamp'].isna()
+    if missing.any():
+        logging.warning(f"Dropping {missing.sum()} txns from blocks without a timestamp.")
+        df = df[~missing]
+    return df.astype({'timeStamp': 'int64'})
@@ -0,0 +1,106 @@
+'''
+Per-txn fees from whole blocks, without a request per txn.
+
+For every txn in a block this gives gas price, effective gas price,
+priority fee (effective price minus base fee), base fee and gas used.
+A block takes two requests: the block with full txns, and its receipts:
+
+- `eth_getBlockReceipts` where the node supports it
+- otherwise one JSON-RPC batch of `eth_getTransactionReceipt` calls
+
+Before London (EIP-1559) there is no base fee; it's recorded as 0,
+so the priority fee is the whole gas price.
+'''
+import logging
+import threading
+
+FIELDNAMES = ['blockNum', 'txnID', 'gasPrice', 'effectiveGasPrice', 'priorityFee', 'baseFee', 'gasUsed']
+
+# JSON-RPC "method not found" / "method not supported"
+UNSUPPORTED_ERROR_CODES = {-32601, -32004}
+
+# endpoint -> whether eth_getBlockReceipts works there
+_BLOCK_RECEIPTS_SUPPORTED = {}
+_LOCK = threading.Lock()
+
+
+def _int(x):
+    if x is None:
+        return None
+    if isinstance(x, str):
+        return int(x, 16)
+    return int(x)
+
+
+def _hex(x):
+    if isinstance(x, str):
+        return x
+    return x.hex()
+
+
+def jsonrpc_batch(endpoint, method, params_list, timeout=60):
+    '''
+    Send one JSON-RPC batch calling `method` once per params in `params_list`.
+    Returns results in the same order; raises on any error.
+    '''
+    # numpy is only needed once we fetch
+    import rawrpc
+    return rawrpc.batch(endpoint, method, params_list, timeout)
+
+
+def get_receipts(web3, block_num, txn_hashes, endpoint):
+    '''
+    Receipts of all txns in block `block_num`, in block order.
+    '''
+    if not txn_hashes:
+        return []
+
+    if _BLOCK_RECEIPTS_SUPPORTED.get(endpoint, True):
+        try:
+            receipts = web3.manager.request_blocking('eth_getBlockReceipts', [hex(block_num)])
+            with _LOCK:
+                _BLOCK_RECEIPTS_SUPPORTED[endpoint] = True
+            return receipts
+        except ValueError as e:
+            error = e.args[0] if e.args else None
+            if not (isinstance(error, dict) and error.get('code') in UNSUPPORTED_ERROR_CODES):
+                raise
+            logging.info(f"{endpoint} doesn't support eth_getBlockReceipts, batching receipt requests.")
+            with _LOCK:
+                _BLOCK_RECEIPTS_SUPPORTED[endpoint] = False
+
+    return jsonrpc_batch(endpoint, 'eth_getTransactionReceipt', [[_hex(h)] for h in txn_hashes])
+
+
+def get_block_fees(web3, block_num, endpoint):
+    '''
+    Return the block's timestamp and a list of rows (see `FIELDNAMES`), one per txn.
+    '''
+    block = web3.eth.getBlock(block_num, full_transactions=True)
+    txns = block['transactions']
+    receipts = get_receipts(web3, block_num, [t['hash'] for t in txns], endpoint)
+    assert len(receipts) == len(txns), f"block {block_num}: {len(receipts)} receipts for {len(txns)} txns"
+
+    base_fee = _int(block.get('baseFeePerGas')) or 0
+
+    rows = []
+    for txn, receipt in zip(txns, receipts):
+        effective = _int(receipt.get('effectiveGasPrice'))
+        if effective is None:
+            # older nodes don't report it
+            max_fee = _int(txn.get('maxFeePerGas'))
+            if max_fee is not None:
+                effective = min(max_fee, base_fee + _int(txn['maxPriorityFeePerGas']))
+            else:
+                effective = _int(txn['gasPrice'])
+        rows.append((
+            block_num,
+            _hex(txn['hash']),
+            _int(txn['gasPrice']),
+            effective,
+            effective - base_fee,
+            base_fee,
+            _int(receipt['gasUsed']),
+        ))
+
+    return block['timestamp'], rows
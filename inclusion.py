@@ -0,0 +1,172 @@
+'''
+Empirical odds that a gas price gets a txn into one of the next k blocks.
+
+For every block b in the history and k = 1..max_k, let min_k(b) be the
+lowest gas price included in blocks b+1..b+k. A txn priced at `price`,
+sent while b is the latest block, is considered included if
+`price > min_k(b)` (same criterion as `is_greater_than_min_next_block`
+in gas-price-predictions.ipynb).
+
+Two tables are precomputed, both shaped (max_k, n):
+
+- by price: P(price > min_k) for log-spaced gas price bins
+- by percentile: P(p-th percentile of block b > min_k), p = 0..100
+
+Queries are a couple of array lookups:
+
+    model = InclusionModel.fit(dataset.iter_ordered_chunks(dataset.find_parts()))
+    model.save('inclusion.npz')
+    model = InclusionModel.load('inclusion.npz')
+    model.p_price(50 * 10**9, k=2)     # 50 gwei, included within 2 blocks
+    model.p_percentile(60, k=1)        # 60th percentile of the latest block
+'''
+import numpy as np
+
+# gas price bins: bin 0 is [0, MIN_PRICE), bin i >= 1 starts at MIN_PRICE * BIN_RATIO ** (i - 1)
+MIN_PRICE = 10 ** 8 # 0.1 gwei
+BIN_RATIO = 1.02
+N_BINS = 800 # up to ~0.1 * 1.02 ** 799 ~ 750k gwei
+MAX_K = 5
+
+PERCENTILES = np.arange(101)
+
+
+def price_bins(prices, min_price=MIN_PRICE, ratio=BIN_RATIO, n_bins=N_BINS):
+    '''Bin index of each price in `prices` (wei).'''
+    prices = np.asarray(prices, dtype='float64')
+    with np.errstate(divide='ignore'):
+        idx = np.floor(np.log(prices / min_price) / np.log(ratio)) + 1
+    idx = np.where(prices < min_price, 0, idx)
+    return np.clip(idx, 0, n_bins - 1).astype('int64')
+
+
+def bin_edges(min_price=MIN_PRICE, ratio=BIN_RATIO, n_bins=N_BINS):
+    '''Lower edge (wei) of every bin.'''
+    edges = min_price * ratio ** (np.arange(n_bins) - 1.0)
+    edges[0] = 0
+    return edges
+
+
+def next_block_minimums(blocks, mins, max_k=MAX_K):
+    '''
+    Given sorted block numbers and their minimum gas prices, return a
+    (max_k, len(blocks)) array with min_k(b), NaN where any of the next
+    k blocks is missing from the data.
+    '''
+    out = np.full((max_k, len(blocks)), np.nan)
+    running = None
+    for k in range(1, max_k + 1):
+        pos = np.searchsorted(blocks, blocks + k)
+        present = pos < len(blocks)
+        present[present] = blocks[pos[present]] == blocks[present] + k
+        nxt = np.full(len(blocks), np.nan)
+        nxt[present] = mins[pos[present]]
+        # NaN poisons the running minimum once a block is missing
+        running = nxt if k == 1 else np.minimum(running, nxt)
+        out[k - 1] = running
+    return out
+
+
+class InclusionModel(object):
+
+    def __init__(self, max_k=MAX_K, min_price=MIN_PRICE, ratio=BIN_RATIO, n_bins=N_BINS):
+        self.max_k = max_k
+        self.min_price = min_price
+        self.ratio = ratio
+        self.n_bins = n_bins
+        # raw counts, so models built from different data can be added up
+        self.n_blocks = np.zeros(max_k, dtype='int64')
+        self.min_hist = np.zeros((max_k, n_bins), dtype='int64')
+        self.pct_hits = np.zeros((max_k, len(PERCENTILES)), dtype='int64')
+        self._finalize()
+
+    @classmethod
+    def fit(cls, chunks, **kwargs):
+        '''
+        Build the model from `chunks` of txns (blockNum, gasPrice), in block
+        order and with no block split across chunks (see `dataset.iter_ordered_chunks`).
+        '''
+        model = cls(**kwargs)
+        carry = None
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            stats = cls._block_stats(chunk)
+            if carry is not None:
+                stats = tuple(np.concatenate([a, b]) for a, b in zip(carry, stats))
+            blocks = stats[0]
+            # the last max_k blocks need data from the next chunk
+            done = blocks + model.max_k <= blocks[-1]
+            model._add(blocks[done], stats[2][done], blocks, stats[1])
+            carry = tuple(a[~done] for a in stats)
+        if carry is not None and len(carry[0]):
+            model._add(carry[0], carry[2], carry[0], carry[1])
+        model._finalize()
+        return model
+
+    @staticmethod
+    def _block_stats(df):
+        g = df.groupby('blockNum')['gasPrice']
+        pcts = g.quantile(PERCENTILES / 100).unstack()
+        return (
+            pcts.index.to_numpy(dtype='int64'),
+            g.min().to_numpy(dtype='float64'),
+            pcts.to_numpy(dtype='float64'),
+        )
+
+    def _add(self, blocks, pcts, all_blocks, all_mins):
+        # min_k is looked up among all known blocks, but only counted for `blocks`
+        min_k = next_block_minimums(all_blocks, all_mins, self.max_k)
+        min_k = min_k[:, np.searchsorted(all_blocks, blocks)]
+        for k in range(self.max_k):
+            valid = ~np.isnan(min_k[k])
+            self.n_blocks[k] += valid.sum()
+            self.min_hist[k] += np.bincount(
+                price_bins(min_k[k][valid], self.min_price, self.ratio, self.n_bins),
+                minlength=self.n_bins,
+            )
+            self.pct_hits[k] += (pcts[valid] > min_k[k][valid][:, None]).sum(axis=0)
+
+    def _finalize(self):
+        n = np.maximum(self.n_blocks, 1)[:, None]
+        # a price in bin i is at least the bin's lower edge, which beats min_k
+        # for every block whose min_k falls in a lower bin
+        below = np.cumsum(self.min_hist, axis=1) - self.min_hist
+        self.price_table = (below / n).astype('float32')
+        self.pct_table = (self.pct_hits / n).astype('float32')
+
+    def merge(self, other):
+        '''Add up the counts of two models built with the same parameters.'''
+        self.n_blocks += other.n_blocks
+        self.min_hist += other.min_hist
+        self.pct_hits += other.pct_hits
+        self._finalize()
+        return self
+
+    def p_price(self, price, k=1):
+        '''P(a txn priced at `price` wei is included within `k` blocks).'''
+        return self.price_table[k - 1, price_bins(price, self.min_price, self.ratio, self.n_bins)]
+
+    def p_percentile(self, p, k=1):
+        '''P(a txn priced at the `p`-th percentile of the latest block is included within `k` blocks).'''
+        return self.pct_table[k - 1, np.clip(np.rint(p), 0, 100).astype('int64')]
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            params=np.array([self.max_k, self.min_price, self.ratio, self.n_bins], dtype='float64'),
+            n_blocks=self.n_blocks,
+            min_hist=self.min_hist,
+            pct_hits=self.pct_hits,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        max_k, min_price, ratio, n_bins = data['params']
+        model = cls(int(max_k), min_price, ratio, int(n_bins))
+        model.n_blocks = data['n_blocks']
+        model.min_hist = data['min_hist']
+        model.pct_hits = data['pct_hits']
+        model._finalize()
+        return model
@@ -1,25 +1,22 @@
 """Utility functions for live test analysis"""
 
-from typing import cast, Set
+from concurrent.futures import ThreadPoolExecutor
 import bisect
 import glob
 import json
-import math
 import os
 import re
-import shelve
+import sys
 import threading
 
-from tqdm.notebook import tqdm
-from web3.auto import w3
-from web3.types import (
-    RPCEndpoint,
-)
 import numpy as np
 import pandas as pd
-import web3
 pd.options.mode.chained_assignment = None
 
+# NOTE: web3 and tqdm are imported where they're used; importing this
+#       module doesn't connect to a node, so loading live test data
+#       works offline
+
 #####################
 ## connect to node ##
 #####################
@@ -28,44 +25,77 @@ class EmptyProvider(Exception):
     # pylint: disable=C0115
     pass
 
-if "WEB3_PROVIDER_URI" not in os.environ:
-    raise EmptyProvider("Environment variable WEB3_PROVIDER_URI is not set.")
+class BlocksNotFetched(Exception):
+    """Blocks that couldn't be fetched, even after retrying."""
+    def __init__(self, blocks):
+        super().__init__(f"Failed to fetch {len(blocks)} blocks: {blocks}")
+        self.blocks = blocks
+
+class Web3Context:
+    """
+    Web3 client with a persistent API cache, created on first use.
 
-assert w3.isConnected(), "problem connecting to node"
+    The provider defaults to the WEB3_PROVIDER_URI environment variable;
+    use `configure` to choose another provider or cache file. Calls that
+    are in the cache are answered without touching the network.
+    """
+    def __init__(self, provider_uri=None, cache_path='api_cache'):
+        self.provider_uri = provider_uri
+        self.cache_path = cache_path
+        self._w3 = None
+        self._lock = threading.Lock()
+
+    @property
+    def w3(self):
+        """The web3 client, connected on first access."""
+        with self._lock:
+            if self._w3 is None:
+                self._w3 = self._connect()
+            return self._w3
+
+    def _connect(self):
+        from web3 import Web3
+        from web3.providers.auto import load_provider_from_uri
+
+        provider_uri = self.provider_uri or os.environ.get("WEB3_PROVIDER_URI")
+        if not provider_uri:
+            raise EmptyProvider("Environment variable WEB3_PROVIDER_URI is not set.")
+
+        w3 = Web3(load_provider_from_uri(provider_uri))
+        _init_cache(w3, self.cache_path)
+        return w3
+
+CONTEXT = Web3Context()
+
+def configure(provider_uri=None, cache_path='api_cache'):
+    """Use a different provider and/or cache file for all API calls."""
+    global CONTEXT # pylint: disable=W0603
+    CONTEXT = Web3Context(provider_uri, cache_path)
+    return CONTEXT
+
+def _w3():
+    return CONTEXT.w3
+
+def _tqdm(total):
+    from tqdm.notebook import tqdm
+    return tqdm(total=total)
 
 ######################
 ## initialize cache ##
 ######################
 
-def _init_cache():
-    def _should_cache(method, params, response):
-        if 'error' in response:
-            return False
-        if 'result' not in response:
-            return False
-        if response['result'] is None:
-            return False
-        return True
-
-    rpc_whitelist = cast(Set[RPCEndpoint], {
-        'eth_getBlockByHash',
-        'eth_getBlockByNumber',
-        'eth_getTransactionByHash',
-        'eth_getTransactionByBlockHashAndIndex',
-        'eth_getTransactionByBlockNumberAndIndex',
-        'eth_getTransactionReceipt',
-    })
-
-    # put in persistent dict-like database via shelve.py
-    db = shelve.open('api_cache', 'c')
-    # create callable
-    cache_class = lambda: db
-    simple_cache = web3.middleware.construct_simple_cache_middleware(
-        cache_class, rpc_whitelist, _should_cache
-    )
-    w3.middleware_onion.add(simple_cache)
-
-_init_cache()
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+def _init_cache(w3, cache_path):
+    """
+    Cache API calls in `cache_path` with the scraper's cache (../../cache.py):
+    blocks near the head are only kept in memory, since they can be reorged.
+    """
+    if ROOT_DIR not in sys.path:
+        sys.path.append(ROOT_DIR)
+    import cache
+
+    w3.middleware_onion.add(cache.construct_cache_middleware(cache.open_cache(cache_path)))
 
 ####################
 ## important note ##
@@ -75,31 +105,111 @@ NOTE: shelve.py does NOT support concurrent processes
 - pandas `apply` is computed in parallel
 - this necessitates a lock when any API calls are made in an `apply` call
 - kinda ugly but must be done
+- (the cache itself is locked, see ../../cache.py, so threads that
+  only fetch data, like `prefetch_blocks`, don't need this lock)
 """
 
 CACHE_LOCK = threading.Lock()
 
+# columns logged by ../src/live-test.js that hold integers
+INT_COLUMNS = [
+    'confirmBlockNumber',
+    'confirmTimestamp',
+    'confirmations',
+    'createTimestamp',
+    'currentBlockTimestamp',
+    'recommendedGasPrice',
+    'sampleGasPrice',
+    'submitBlockNumber',
+    'submitTimestamp',
+    'usedGasPrice']
+
+class LiveTestTail:
+    """
+    Read the append-only logs of ../src/live-test.js (`txes_<method>.jsonl`,
+    one JSON record per line) incrementally.
+
+    Each call to `read` returns only the records appended since the
+    previous call, so analysis can run while a live test is in progress:
+
+        tail = LiveTestTail()
+        df = tail.read()
+        ...
+        df = pd.concat([df, tail.read()], ignore_index=True)
+    """
+    # method name from a log file's name
+    file_pattern = r'txes_(.*)\.jsonl$'
+
+    def __init__(self, pattern='../txes_*.jsonl'):
+        self.pattern = pattern
+        # filename -> byte offset up to which records have been read
+        self.offsets = {}
+
+    def read(self):
+        """Return new records from all log files as a DataFrame."""
+        records = []
+        methods = []
+        for filename in sorted(glob.glob(self.pattern)):
+            method = re.match(self.file_pattern, os.path.basename(filename)).group(1)
+            new = self._read_file(filename)
+            records.extend(new)
+            methods.extend([method] * len(new))
+        return _records_to_df(records, methods)
+
+    def _read_file(self, filename):
+        with open(filename, 'rb') as log_file:
+            log_file.seek(self.offsets.get(filename, 0))
+            data = log_file.read()
+        # a record may be half-written; leave it for the next read
+        end = data.rfind(b'\n') + 1
+        self.offsets[filename] = self.offsets.get(filename, 0) + end
+        return [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+
+def _records_to_df(records, methods):
+    """Build a DataFrame from log records, converting int columns on the way."""
+    columns = {}
+    for i, record in enumerate(records):
+        for key, value in record.items():
+            if key not in columns:
+                columns[key] = [None] * i
+            columns[key].append(value)
+        for key, values in columns.items():
+            if len(values) <= i:
+                values.append(None)
+
+    for col in INT_COLUMNS:
+        if col in columns:
+            columns[col] = pd.array(
+                [None if v is None else int(v) for v in columns[col]],
+                dtype=pd.Int64Dtype()
+            )
+
+    df = pd.DataFrame(columns, index=pd.RangeIndex(len(records))) #pylint: disable=C0103
+    df['method'] = methods
+    return df
+
 def load_live_test_data():
     """
-    Load json files that are the log/output files of ../src/live-test.js.
+    Load the log/output files of ../src/live-test.js.
+
+    Reads the append-only `txes_*.jsonl` logs, as well as `txes_*.json`
+    files written by older versions of live-test.js.
     """
-    file_pattern = '../txes_(.*)\.json'
+    file_pattern = r'txes_(.*)\.json$'
 
     json_files = glob.glob('../txes_*.json')
+    tail = LiveTestTail()
 
-    print(f'Reading from {json_files}')
+    print(f'Reading from {json_files + sorted(glob.glob(tail.pattern))}')
 
-    dfs = []
+    dfs = [tail.read()]
 
     for filename in json_files:
-        method = re.match(file_pattern, filename).group(1)
+        method = re.match(file_pattern, os.path.basename(filename)).group(1)
         with open(filename, 'r') as data_file:
             json_data = json.loads(data_file.read())
 
-        df = pd.DataFrame.from_records(json_data) #pylint: disable=C0103
-        df['method'] = method
-
-        dfs.append(df)
+        dfs.append(_records_to_df(json_data, [method] * len(json_data)))
 
     df = pd.concat(dfs, ignore_index=True) #pylint: disable=C0103
     return df
@@ -108,20 +218,9 @@ def convert_to_int(df):
     """
     Inplace convert all relevant columns to ints.
     """
-    # convert floats to ints
-    for col in [
-        'confirmBlockNumber',
-        'confirmTimestamp',
-        'confirmations',
-        'createTimestamp',
-        'recommendedGasPrice',
-        'sampleGasPrice',
-        'submitBlockNumber',
-        'submitTimestamp',
-        'usedGasPrice']:
-
-        df[col].replace({None: float('nan')}, inplace=True)
-        df[col] = df[col].astype(pd.Int64Dtype())
+    for col in INT_COLUMNS:
+        if col in df:
+            df[col] = pd.to_numeric(df[col]).astype(pd.Int64Dtype())
 
 def validate(df, pbar=False):
     '''
@@ -139,7 +238,7 @@ def validate(df, pbar=False):
     '''
 
     if pbar:
-        pbar = tqdm(total=df.shape[0])
+        pbar = _tqdm(total=df.shape[0])
 
     df = df.apply(_validate_row, axis=1, pbar=pbar)
 
@@ -155,6 +254,8 @@ def _validate_row(row, pbar):
     ## check txn hash
     ##
 
+    from web3.exceptions import TransactionNotFound
+
     txn_hash = row['hash']
     if not txn_hash:
         # unmined txn
@@ -166,11 +267,10 @@ def _validate_row(row, pbar):
 
     bx = row['submitBlockNumber']
     # this should not be empty
-    assert bx
-    assert not math.isnan(bx)
+    assert not pd.isna(bx)
 
     with CACHE_LOCK:
-        block = w3.eth.getBlock(int(bx))
+        block = _w3().eth.getBlock(int(bx))
 
     row['submitTimestamp'] = _check_submit_block_ts(block, row['submitTimestamp'])
 
@@ -182,9 +282,9 @@ def _validate_row(row, pbar):
     try:
 
         with CACHE_LOCK:
-            txn = w3.eth.getTransaction(txn_hash)
+            txn = _w3().eth.getTransaction(txn_hash)
 
-    except web3.exceptions.TransactionNotFound:
+    except TransactionNotFound:
         print(f"Txn {txn_hash} not found.")
         return
 
@@ -192,7 +292,7 @@ def _validate_row(row, pbar):
 
     # get confirm block from blockchain
     with CACHE_LOCK:
-        block = w3.eth.getBlock(row['confirmBlockNumber'])
+        block = _w3().eth.getBlock(row['confirmBlockNumber'])
 
     row['confirmTimestamp'] = _check_confirm_block_ts(txn_hash, block, row['confirmTimestamp'])
 
@@ -215,7 +315,7 @@ def _check_submit_block_ts(block, ts_reported):
     """Check submit block timestamp."""
     ts = block.timestamp
 
-    if math.isnan(ts_reported):
+    if pd.isna(ts_reported):
         #print(f"Warning: empty submit timestamp for {txn_hash}")
         pass # warning too common
 
@@ -228,7 +328,7 @@ def _check_confirm_block_txn(txn, bx_reported):
     """Check that `txn` was in fact mined in `block`."""
 
     # might be empty
-    if not bx_reported or math.isnan(bx_reported):
+    if pd.isna(bx_reported) or not bx_reported:
         # get block number from txn hash
         bx = int(txn.blockNumber)
     else:
@@ -241,10 +341,10 @@ def _check_confirm_block_ts(txn_hash, block, ts_reported):
     """Check confirm block timestamp."""
     ts = block.timestamp
 
-    if math.isnan(ts_reported):
+    if pd.isna(ts_reported):
         print(f"Warning: empty confirm timestamp for {txn_hash}")
 
-    if ts != ts_reported:
+    elif ts != ts_reported:
         print(f"Warning: matched timestamps for Block {block.number}: {ts}, {ts_reported}")
 
     return ts
@@ -267,7 +367,7 @@ def get_mined_df(df, pbar=False):
 
         ts1 = row['createTimestamp']
 
-        if not math.isnan(row['confirmTimestamp']):
+        if not pd.isna(row['confirmTimestamp']):
             ts2 = row['confirmTimestamp']
         else:
             ts2 = ts1 + 60
@@ -288,7 +388,7 @@ def get_mined_df(df, pbar=False):
         )
 
     if pbar:
-        pbar = tqdm(total=df.shape[0])
+        pbar = _tqdm(total=df.shape[0])
 
     return df.apply(_get_unmined_blocks, axis=1, args=(pbar,))
 
@@ -296,14 +396,14 @@ def _get_blocks_in_range(ts1, ts2, block_hint):
     bxs = []
 
     with CACHE_LOCK:
-        block = w3.eth.getBlock(block_hint)
+        block = _w3().eth.getBlock(block_hint)
 
     while block.timestamp < ts2:
         if block.timestamp > ts1:
             bxs.append(block.number)
 
         with CACHE_LOCK:
-            block = w3.eth.getBlock(block.number + 1)
+            block = _w3().eth.getBlock(block.number + 1)
 
     return bxs
 
@@ -327,7 +427,76 @@ def get_historical_transaction_data():
 
     return df
 
-def get_percentile_df(df_mined, df_hist, pbar=False):
+def get_referenced_blocks(df_mined):
+    """
+    All blocks `get_percentile_df` will look up for `df_mined`
+    (see `get_mined_df`): mined blocks and unmined blocks.
+    """
+    bxs = set()
+    for col in ['mined_block', 'unmined_blocks']:
+        for value in df_mined[col]:
+            for bx in (value if isinstance(value, list) else [value]):
+                if not pd.isna(bx):
+                    bxs.add(int(bx))
+    return bxs
+
+def prefetch_blocks(bxs, nthreads=16, pbar=False, retries=2):
+    """
+    Fetch all txns of blocks `bxs`, `nthreads` blocks at a time; blocks
+    that fail are tried again up to `retries` times.
+
+    Returns a DataFrame with columns ['blockNum', 'txnHash', 'gasPrice'],
+    like `get_historical_transaction_data`, and the list of blocks that
+    couldn't be fetched.
+    """
+    bxs = sorted(bxs)
+    if pbar:
+        pbar = _tqdm(total=len(bxs))
+
+    def _fetch(bx):
+        try:
+            txns = _get_block_txns(bx)
+        except Exception as e: #pylint: disable=W0703
+            print(f"Failed to fetch block {bx}: {e!r}")
+            txns = None
+        if pbar:
+            pbar.update(1)
+        return bx, txns
+
+    rows, failed = [], bxs
+    for _ in range(1 + retries):
+        bxs, failed = failed, []
+        with ThreadPoolExecutor(nthreads) as pool:
+            for bx, txns in pool.map(_fetch, bxs):
+                if txns is None:
+                    failed.append(bx)
+                else:
+                    rows.extend((bx, txn_hash, gas_price) for txn_hash, gas_price in txns)
+        if not failed:
+            break
+
+    df = pd.DataFrame(rows, columns=['blockNum', 'txnHash', 'gasPrice'])
+    return df, failed
+
+def fill_missing_blocks(df_mined, df_hist, nthreads=16, pbar=False):
+    """
+    Return `df_hist` with the txns of all blocks referenced by `df_mined`
+    that it doesn't have yet, fetched in parallel.
+
+    Keep the result around (e.g. pass it to `get_percentile_df`) so
+    blocks are only fetched once (except blocks without txns, which
+    have no rows).
+    """
+    missing = get_referenced_blocks(df_mined) - set(df_hist.blockNum.unique())
+    print(f"Fetching {len(missing)} blocks missing from historical data.")
+    df_new, failed = prefetch_blocks(missing, nthreads, pbar)
+    if failed:
+        # they're fetched again by `get_percentile_df`
+        print(f"Failed to fetch {len(failed)} blocks: {failed}")
+    df = pd.concat([df_hist, df_new], ignore_index=True)
+    return df.sort_values('blockNum', kind='stable').reset_index(drop=True)
+
+def get_percentile_df(df_mined, df_hist, pbar=False, nthreads=16):
     """
     Returns DataFrame with columns:
     - hash
@@ -335,7 +504,27 @@ def get_percentile_df(df_mined, df_hist, pbar=False):
     - usedGasPrice
     - percentile
     - mined?
+
+    Blocks missing from `df_hist` are fetched up front, in parallel
+    (see `prefetch_blocks`), so computing percentiles doesn't make any
+    API calls. Raises `BlocksNotFetched` if some can't be fetched.
     """
+    # block -> sorted gas prices
+    gas_prices_by_block = {
+        bx: sorted(prices.tolist())
+        for bx, prices in df_hist.groupby('blockNum')['gasPrice']
+    }
+    missing = get_referenced_blocks(df_mined) - gas_prices_by_block.keys()
+    if missing:
+        df_new, failed = prefetch_blocks(missing, nthreads, pbar)
+        if failed:
+            raise BlocksNotFetched(failed)
+        # blocks without txns stay in the map as empty lists
+        for bx in missing:
+            gas_prices_by_block.setdefault(bx, [])
+        for bx, prices in df_new.groupby('blockNum')['gasPrice']:
+            gas_prices_by_block[bx] = sorted(prices.tolist())
+
     def _get_percentile(row, col, pbar=None):
         if pbar:
             pbar.update(1)
@@ -344,16 +533,11 @@ def get_percentile_df(df_mined, df_hist, pbar=False):
             bxs = [bxs]
         ps = []
         for bx in bxs:
-            gas_prices = df_hist[df_hist.blockNum == bx]['gasPrice']
-            gas_prices = gas_prices.tolist()
-            if len(gas_prices) == 0:
-                gas_prices = _get_gas_prices(bx)
-                if len(gas_prices) == 0:
-                    ps.append(float('nan'))
-                    continue
-            #gas_prices = list(map(int, gas_prices))
-            gas_prices.sort()
-            #print(gas_prices)
+            # NaN block (e.g. not mined yet), or empty: block without txns
+            gas_prices = None if pd.isna(bx) else gas_prices_by_block.get(int(bx))
+            if not gas_prices:
+                ps.append(float('nan'))
+                continue
             p = bisect.bisect(gas_prices, int(row['usedGasPrice'])) / len(gas_prices) * 100
             # round for easier analysis
             p = round(p, 2)
@@ -364,11 +548,12 @@ def get_percentile_df(df_mined, df_hist, pbar=False):
         return pd.Series(row)
 
     if pbar:
-        pbar = tqdm(total=df_mined.shape[0])
+        pbar = _tqdm(total=df_mined.shape[0])
 
     df_percentile = df_mined.apply(_get_percentile, axis=1, args=('unmined_blocks', pbar))
 
-    pbar = tqdm(total=df_percentile.shape[0])
+    if pbar:
+        pbar = _tqdm(total=df_percentile.shape[0])
 
     df_percentile = df_percentile.apply(_get_percentile, axis=1, args=('mined_block', pbar))
 
@@ -390,24 +575,9 @@ def get_percentile_df(df_mined, df_hist, pbar=False):
 
     return df_percentile
 
-def _get_gas_prices(bx):
+def _get_block_txns(bx):
     """
-    Get all gas prices for txns in `bx`.
+    (hash, gas price) of all txns in `bx`, from a single API call.
     """
-    prices = []
-    try:
-
-        with CACHE_LOCK:
-            block = w3.eth.getBlock(bx)
-
-    except TypeError:
-        return []
-
-    for txn_hash in block.transactions:
-
-        with CACHE_LOCK:
-            txn = w3.eth.getTransaction(txn_hash)
-
-        prices.append(txn.gasPrice)
-
-    return prices
+    block = _w3().eth.getBlock(bx, full_transactions=True)
+    return [(txn.hash.hex(), txn.gasPrice) for txn in block.transactions]
@@ -39,13 +39,10 @@ module.exports = {
     return readLogJson(filePath)[name];
   },
   addTx: function (testCase, entry) {
-    let txes = [];
-    const filePath = `./txes_${testCase}.json`;
-    if (fs.existsSync(filePath)) {
-      txes = JSON.parse(fs.readFileSync(filePath, 'utf-8'));
-    }
-    txes.push(entry);
-    fs.writeFileSync(filePath, JSON.stringify(txes, null, 4));
+    // One JSON record per line, appended; never re-read or rewritten,
+    // so concurrent test cases and readers tailing the file don't race.
+    const filePath = `./txes_${testCase}.jsonl`;
+    fs.appendFileSync(filePath, JSON.stringify(entry) + '\n');
   },
   sleep: function (ms) {
     return new Promise(resolve => setTimeout(resolve, ms));
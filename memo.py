@@ -0,0 +1,227 @@
+'''
+Memoization of simulation/analysis results (DataFrames) on disk.
+
+Results are keyed by everything they depend on: the dataset (see
+`dataset.fingerprint`), parameters such as the wake-up schedule, and the
+source code that computed them (see `code_version`). Each result is
+stored column-wise in its own compressed `.npz` file; once the cache
+grows past `max_bytes`, the least recently used results are dropped.
+
+    cache = memo.ResultCache('.memo')
+    key = memo.make_key(dataset.fingerprint(paths), wake_up_times, memo.code_version(_airnode_sim_utils))
+    df_results = memo.memoize_per_strategy(
+        cache, key, ['recommended', 'boosted_1.5', 'boosted_2.0'],
+        lambda methods: _airnode_sim_utils.airnode_sim(df, wake_up_times, methods),
+    )
+
+With `memoize_per_strategy` each strategy is cached separately, so adding
+or changing one strategy only computes that one. Strategies whose name
+doesn't say everything about them are passed with a spec, e.g. for
+`_replay` strategies `{'boosted': {'boost': 1.5, 'window': 20}}`.
+
+Keys are only made of values with a stable encoding; anything else, e.g.
+a function, raises TypeError rather than silently getting a key that
+differs in every process.
+'''
+import datetime
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def _default(o):
+    # arrays/frames are hashed rather than serialized, e.g. wake-up schedules
+    if isinstance(o, (pd.DataFrame, pd.Series, pd.Index)):
+        return hashlib.sha256(pd.util.hash_pandas_object(o).to_numpy().tobytes()).hexdigest()
+    if isinstance(o, np.ndarray):
+        return hashlib.sha256(str(o.dtype).encode() + np.ascontiguousarray(o).tobytes()).hexdigest()
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, (set, frozenset)):
+        return sorted(o)
+    if isinstance(o, (datetime.date, datetime.time, pd.Timestamp)):
+        return o.isoformat()
+    raise TypeError(
+        f"can't make a stable key of {type(o).__name__} {o!r}; "
+        "pass its parameters or code_version() instead")
+
+
+def make_key(*parts):
+    '''A hex digest identifying `parts` (strings, numbers, lists, dicts, arrays, frames...).'''
+    data = json.dumps(parts, default=_default, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def code_version(*objs):
+    '''
+    A hex digest of the source code of `objs` (modules, functions or
+    classes), so results are recomputed when the code changes.
+    '''
+    h = hashlib.sha256()
+    for obj in objs:
+        h.update(inspect.getsource(obj).encode())
+    return h.hexdigest()
+
+
+def _to_arrays(df):
+    '''Columns of `df` (and its index) as a dict of numpy arrays.'''
+    index_names = [n if n is not None else '__index__' for n in df.index.names]
+    flat = df.reset_index()
+    flat.columns = index_names + list(df.columns)
+
+    arrays = {}
+    meta = {'index': index_names, 'columns': [], 'dtypes': []}
+    for i, name in enumerate(flat.columns):
+        col = flat.iloc[:, i]
+        if isinstance(col.dtype, np.dtype) and col.dtype.kind in 'biufcmM':
+            arrays[f'c{i}'] = col.to_numpy()
+        else:
+            # strings, lists, nullable ints, ...
+            arrays[f'c{i}'] = col.to_numpy(dtype=object)
+        meta['columns'].append(name)
+        meta['dtypes'].append(str(col.dtype))
+    arrays['meta'] = np.array(json.dumps(meta, default=str))
+    return arrays
+
+
+def _from_arrays(data):
+    meta = json.loads(str(data['meta']))
+    columns = {}
+    for i, (name, dtype) in enumerate(zip(meta['columns'], meta['dtypes'])):
+        col = pd.Series(data[f'c{i}'])
+        if dtype != str(col.dtype) and dtype != 'object':
+            col = col.astype(dtype)
+        columns[i] = col
+    df = pd.DataFrame(columns)
+    df.columns = meta['columns']
+    df = df.set_index(meta['index'])
+    if df.index.names == ['__index__']:
+        df.index.name = None
+    return df
+
+
+class ResultCache(object):
+    '''
+    Directory of results, one `<key>.npz` file each. A file's size and
+    modification time (bumped on every read) are all the bookkeeping there
+    is, so several instances, e.g. notebook kernels, can share a directory.
+    '''
+
+    def __init__(self, directory='.memo', max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def _entries(self):
+        '''key -> (size, last access time in ns) of all stored results'''
+        entries = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # evicted by another instance
+                continue
+            entries[entry.name[:-len('.npz')]] = (stat.st_size, stat.st_mtime_ns)
+        return entries
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        '''The DataFrame stored under `key`, or None.'''
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=True) as data:
+                df = _from_arrays(data)
+            now = time.time_ns()
+            os.utime(path, ns=(now, now))
+        except FileNotFoundError:
+            return None
+        return df
+
+    def put(self, key, df):
+        '''Store DataFrame `df` under `key`, evicting old results if needed.'''
+        path = self._path(key)
+        # readers never see a partly written file
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **_to_arrays(df))
+        os.replace(tmp, path)
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for size, _ in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k][1]):
+            if total <= self.max_bytes:
+                break
+            total -= entries[key][0]
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                continue
+            logging.info(f"Evicted cached result {key}.")
+
+    def size(self):
+        return sum(size for size, _ in self._entries().values())
+
+    def clear(self):
+        with self.lock:
+            for key in self._entries():
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+
+
+def memoize(cache, key, fn):
+    '''Return the result stored under `key`, or compute it with `fn()` and store it.'''
+    df = cache.get(key)
+    if df is None:
+        df = fn()
+        cache.put(key, df)
+    return df
+
+
+def memoize_per_strategy(cache, key, strategies, fn, column='method'):
+    '''
+    Like `memoize` for results with one group of rows per strategy
+    (e.g. `airnode_sim`'s `method` column), each stored under its own key.
+
+    `strategies` is a dict of strategy name -> spec, anything that changes
+    when the strategy does (its parameters, `code_version` of its function),
+    or a list of names of strategies that never change.
+
+    `fn(names)` is only called with the strategies that aren't cached;
+    the result has the rows of all `strategies`, in that order.
+    '''
+    if not isinstance(strategies, dict):
+        strategies = dict.fromkeys(strategies)
+    keys = {s: make_key(key, s, spec) for s, spec in strategies.items()}
+    results = {s: cache.get(k) for s, k in keys.items()}
+
+    missing = [s for s in strategies if results[s] is None]
+    if missing:
+        logging.info(f"Computing {len(missing)} of {len(strategies)} strategies.")
+        df = fn(missing)
+        for s in missing:
+            results[s] = df[df[column] == s]
+            cache.put(keys[s], results[s])
+
+    return pd.concat([results[s] for s in strategies])
@@ -0,0 +1,219 @@
+'''
+Rate limiting, adaptive concurrency and retries for JSON-RPC calls.
+
+Every endpoint gets one shared `EndpointLimiter` (see `get_limiter`) so
+that all threads talking to the same node draw from the same budget:
+
+- a token bucket caps requests per second
+- an AIMD concurrency limit caps requests in flight; it shrinks on
+  429s/timeouts and grows back slowly on success (scrape.py runs enough
+  threads by default for this limit, not the thread count, to be the cap)
+- throttled calls are retried with jittered exponential backoff, as long
+  as the retry budget (a fraction of recent requests) allows it
+
+`construct_rate_limit_middleware` plugs a limiter into a web3 instance.
+'''
+import logging
+import random
+import threading
+import time
+
+from config import (
+    RPC_MAX_CONCURRENCY,
+    RPC_MAX_RETRIES,
+    RPC_REQUESTS_PER_SECOND,
+)
+
+# JSON-RPC error codes used by providers to signal throttling
+# -32005: Infura "limit exceeded", 429: some gateways echo the http status
+THROTTLE_ERROR_CODES = {-32005, 429}
+RETRYABLE_HTTP_STATUS = {429, 502, 503, 504}
+
+
+class RateLimitError(Exception):
+    '''Raised when a node throttles us and we've run out of retries.'''
+    pass
+
+
+class TokenBucket(object):
+    '''
+    Classic token bucket: `rate` tokens per second, bursts up to `capacity`.
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, tokens=1):
+        '''Block until `tokens` tokens are available and take them.'''
+        # a request bigger than the bucket waits for a full bucket
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency(object):
+    '''
+    Additive-increase / multiplicative-decrease limit on requests in flight.
+
+    Each success raises the limit by ~1 per "window" of `limit` requests;
+    each throttling signal cuts it by `backoff`.
+    '''
+    def __init__(self, initial=8, min_limit=1, max_limit=RPC_MAX_CONCURRENCY, backoff=0.7):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def release(self, ok=True, throttled=False):
+        with self.cond:
+            self.inflight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            elif ok:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+class RetryBudget(object):
+    '''
+    Retries are only allowed while they make up less than `ratio` of
+    recent requests. Keeps a struggling node from getting hammered by
+    retry storms.
+    '''
+    def __init__(self, ratio=0.2, initial=10, capacity=100):
+        self.ratio = ratio
+        self.tokens = float(initial)
+        self.capacity = capacity
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+def backoff_delay(attempt, base=0.25, cap=10.0):
+    '''Exponential backoff with "full jitter".'''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_throttled(exc):
+    '''Whether `exc` means the node is overloaded and the call may be retried.'''
+    import requests
+
+    if isinstance(exc, RateLimitError):
+        return True
+    if isinstance(exc, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        return exc.response.status_code in RETRYABLE_HTTP_STATUS
+    return False
+
+
+def _throttle_error(response):
+    '''
+    The error of a throttled JSON-RPC response, or of any throttled
+    response of a batch (a list of responses); None if not throttled.
+    '''
+    for r in (response if isinstance(response, list) else [response]):
+        error = r.get('error') if isinstance(r, dict) else None
+        if not isinstance(error, dict):
+            continue
+        if error.get('code') in THROTTLE_ERROR_CODES or 'rate limit' in str(error.get('message', '')).lower():
+            return error
+    return None
+
+
+class EndpointLimiter(object):
+    '''
+    Bundles the token bucket, concurrency limit and retry budget of one endpoint.
+    '''
+    def __init__(self, endpoint, rate=RPC_REQUESTS_PER_SECOND, max_retries=RPC_MAX_RETRIES):
+        self.endpoint = endpoint
+        self.bucket = TokenBucket(rate)
+        self.concurrency = AdaptiveConcurrency()
+        self.budget = RetryBudget()
+        self.max_retries = max_retries
+
+    def call(self, fn, *args, **kwargs):
+        '''
+        Call `fn`, respecting the rate/concurrency limits and retrying throttled calls.
+        '''
+        return self.call_batch(1, fn, *args, **kwargs)
+
+    def call_batch(self, n, fn, *args, **kwargs):
+        '''
+        Like `call`, for a JSON-RPC batch of `n` requests: counts as `n` against the rate limit.
+        '''
+        attempt = 0
+        while True:
+            self.bucket.acquire(n)
+            self.concurrency.acquire()
+            self.budget.deposit()
+            try:
+                result = fn(*args, **kwargs)
+                error = _throttle_error(result)
+                if error is not None:
+                    raise RateLimitError(f"{self.endpoint}: {error}")
+            except Exception as e:
+                throttled = is_throttled(e)
+                self.concurrency.release(ok=False, throttled=throttled)
+                if not throttled or attempt >= self.max_retries or not self.budget.withdraw():
+                    raise
+                delay = backoff_delay(attempt)
+                logging.debug(f"{self.endpoint} throttled ({e!r}), retry {attempt + 1} in {delay:.2f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.concurrency.release(ok=True)
+            return result
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+def get_limiter(endpoint):
+    '''Return the limiter shared by all connections to `endpoint`.'''
+    with _LIMITERS_LOCK:
+        if endpoint not in _LIMITERS:
+            _LIMITERS[endpoint] = EndpointLimiter(endpoint)
+        return _LIMITERS[endpoint]
+
+
+def construct_rate_limit_middleware(limiter):
+    '''
+    web3 middleware routing every request through `limiter`.
+    '''
+    def rate_limit_middleware(make_request, web3):
+        def middleware(method, params):
+            return limiter.call(make_request, method, params)
+        return middleware
+    return rate_limit_middleware
@@ -0,0 +1,264 @@
+#!/usr/local/bin/python3
+'''
+Lean JSON-RPC client for bulk block fetches.
+
+web3 runs every response through its middlewares and result formatters
+(AttributeDicts, every hex field converted, addresses checksummed), while
+we only keep block number, timestamp and the txns' hashes and gas prices.
+This sends raw JSON-RPC batches, parses responses with orjson when it's
+installed (json otherwise) and decodes just those fields, a whole batch at
+a time, into numpy arrays:
+
+    blocks = rawrpc.get_blocks(endpoint, range(10_500_000, 10_500_100))
+    blocks.number, blocks.timestamp, blocks.txn_count   # per block
+    blocks.txn_block, blocks.txn_hash, blocks.gas_price # per txn
+
+Responses don't go through the web3 response cache (see cache.py).
+
+Run `python rawrpc.py` to compare decode cost per block with web3
+(on synthetic blocks, or real ones with --endpoint).
+'''
+import argparse
+from itertools import repeat
+import json
+import time
+
+import numpy as np
+
+from config import RAW_BATCH_SIZE
+from ratelimit import get_limiter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# blocks per JSON-RPC batch
+BATCH_SIZE = RAW_BATCH_SIZE
+
+
+def loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def dumps(obj):
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+
+def hex_to_int(values, dtype='uint64'):
+    '''Decode hex quantities, e.g. '0x1a', into a numpy array.'''
+    return np.fromiter(map(int, values, repeat(16)), dtype=dtype, count=len(values))
+
+
+def batch(endpoint, method, params_list, timeout=60, session=None):
+    '''
+    Send one JSON-RPC batch calling `method` once per params in `params_list`.
+    Returns results in the same order; raises on any error.
+    '''
+    import requests
+
+    payload = dumps([
+        {'jsonrpc': '2.0', 'id': i, 'method': method, 'params': params}
+        for i, params in enumerate(params_list)
+    ])
+
+    def post():
+        response = (session or requests).post(
+            endpoint, data=payload, headers={'Content-Type': 'application/json'}, timeout=timeout,
+        )
+        response.raise_for_status()
+        return loads(response.content)
+
+    responses = get_limiter(endpoint).call_batch(len(params_list), post)
+    responses = sorted(responses, key=lambda r: r['id'])
+    for r in responses:
+        if 'error' in r:
+            raise ValueError(f"{method} failed: {r['error']}")
+    return [r['result'] for r in responses]
+
+
+class Blocks(object):
+    '''Per block and per txn columns of a batch of blocks.'''
+
+    def __init__(self, number, timestamp, txn_count, txn_block, txn_hash, gas_price):
+        self.number = number
+        self.timestamp = timestamp
+        self.txn_count = txn_count
+        self.txn_block = txn_block
+        self.txn_hash = txn_hash
+        # None without full txns
+        self.gas_price = gas_price
+
+    def __len__(self):
+        return len(self.number)
+
+    @classmethod
+    def concat(cls, batches):
+        batches = list(batches)
+        if not batches:
+            return parse_blocks([])
+        gas_prices = [b.gas_price for b in batches]
+        return cls(
+            *(np.concatenate([getattr(b, a) for b in batches]) for a in ['number', 'timestamp', 'txn_count', 'txn_block', 'txn_hash']),
+            None if any(g is None for g in gas_prices) else np.concatenate(gas_prices),
+        )
+
+    def rows(self):
+        '''(blockNum, txnID, gasPrice) rows, as written by scrape.py.'''
+        return list(zip(self.txn_block.tolist(), self.txn_hash.tolist(), self.gas_price.tolist()))
+
+
+def parse_blocks(results, full_transactions=True):
+    '''Extract the `Blocks` columns from eth_getBlockByNumber results.'''
+    txns = [t for r in results for t in r['transactions']]
+    txn_count = np.fromiter((len(r['transactions']) for r in results), dtype='int64', count=len(results))
+    number = hex_to_int([r['number'] for r in results], 'int64')
+
+    if full_transactions:
+        txn_hash = np.array([t['hash'] for t in txns], dtype=object)
+        gas_price = hex_to_int([t['gasPrice'] for t in txns])
+    else:
+        txn_hash = np.array(txns, dtype=object)
+        gas_price = None
+
+    return Blocks(
+        number=number,
+        timestamp=hex_to_int([r['timestamp'] for r in results], 'int64'),
+        txn_count=txn_count,
+        txn_block=np.repeat(number, txn_count),
+        txn_hash=txn_hash,
+        gas_price=gas_price,
+    )
+
+
+def get_blocks(endpoint, block_nums, full_transactions=True, batch_size=BATCH_SIZE, session=None):
+    '''
+    Fetch blocks `block_nums`, `batch_size` blocks per request.
+    '''
+    block_nums = list(block_nums)
+    batches = []
+    for i in range(0, len(block_nums), batch_size):
+        nums = block_nums[i:i + batch_size]
+        results = batch(endpoint, 'eth_getBlockByNumber', [[hex(n), full_transactions] for n in nums], session=session)
+        missing = [n for n, r in zip(nums, results) if r is None]
+        if missing:
+            raise ValueError(f"blocks not found: {missing}")
+        batches.append(parse_blocks(results, full_transactions))
+    return Blocks.concat(batches)
+
+
+def get_block_prices(endpoint, block_nums, session=None):
+    '''
+    Fetch blocks `block_nums` and return a dict of block number ->
+    (timestamp, (blockNum, txnID, gasPrice) rows of all its txns);
+    see scrape.py --raw.
+    '''
+    blocks = get_blocks(endpoint, block_nums, session=session)
+    rows = blocks.rows()
+    prices = {}
+    start = 0
+    for n, ts, count in zip(blocks.number.tolist(), blocks.timestamp.tolist(), blocks.txn_count.tolist()):
+        prices[n] = (ts, rows[start:start + count])
+        start += count
+    return prices
+
+
+##
+## benchmark
+##
+
+def synthetic_block(number, ntxns, seed=0):
+    '''An eth_getBlockByNumber response with full txns, like a node's.'''
+    rng = np.random.default_rng(seed + number)
+    h = lambda: '0x' + rng.bytes(32).hex()
+    a = lambda: '0x' + rng.bytes(20).hex()
+    txns = [{
+        'blockHash': '0x' + '00' * 32, 'blockNumber': hex(number), 'from': a(), 'gas': hex(21000),
+        'gasPrice': hex(int(rng.integers(10**9, 10**12))), 'hash': h(), 'input': '0x',
+        'nonce': hex(int(rng.integers(10**6))), 'to': a(), 'transactionIndex': hex(i), 'value': hex(10**18),
+        'type': '0x0', 'v': '0x25', 'r': h(), 's': h(),
+    } for i in range(ntxns)]
+    result = {
+        'number': hex(number), 'hash': h(), 'parentHash': h(), 'timestamp': hex(1_600_000_000 + 13 * number),
+        'difficulty': '0x1', 'totalDifficulty': '0x1', 'extraData': '0x', 'gasLimit': hex(12_500_000),
+        'gasUsed': hex(12_000_000), 'logsBloom': '0x' + '00' * 256, 'miner': a(), 'mixHash': h(),
+        'nonce': '0x0000000000000000', 'receiptsRoot': h(), 'sha3Uncles': h(), 'size': '0x1',
+        'stateRoot': h(), 'transactionsRoot': h(), 'uncles': [], 'transactions': txns,
+    }
+    return json.dumps({'jsonrpc': '2.0', 'id': 0, 'result': result}).encode()
+
+
+def fetch_raw_blocks(endpoint, block_nums):
+    '''Raw responses of eth_getBlockByNumber with full txns, one per block.'''
+    import requests
+    raw = []
+    for n in block_nums:
+        payload = {'jsonrpc': '2.0', 'id': 0, 'method': 'eth_getBlockByNumber', 'params': [hex(n), True]}
+        response = requests.post(endpoint, json=payload, timeout=60)
+        response.raise_for_status()
+        raw.append(response.content)
+    return raw
+
+
+def benchmark(raw_blocks, rounds=3):
+    '''
+    Seconds per block to decode `raw_blocks` (raw JSON-RPC responses)
+    with web3's provider + formatters, and with `parse_blocks`.
+    Only decoding is timed; no requests are made.
+    '''
+    from web3 import Web3
+    from web3.providers.base import BaseProvider
+
+    by_number = {int(json.loads(r)['result']['number'], 16): r for r in raw_blocks}
+
+    class CannedProvider(BaseProvider):
+        # decodes responses the way HTTPProvider does
+        def make_request(self, method, params):
+            return json.loads(by_number[int(params[0], 16)])
+
+    web3 = Web3(CannedProvider())
+
+    def web3_path():
+        for n in by_number:
+            block = web3.eth.get_block(n, full_transactions=True)
+            [(t['hash'], t['gasPrice']) for t in block['transactions']]
+
+    def raw_path():
+        parse_blocks([loads(r)['result'] for r in raw_blocks])
+
+    timings = {}
+    for name, fn in [('web3', web3_path), ('raw', raw_path)]:
+        best = float('inf')
+        for _ in range(rounds):
+            start = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best / len(raw_blocks)
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark block decoding: web3 vs raw JSON-RPC.')
+    parser.add_argument('--endpoint', help='fetch real blocks from this node (default: synthetic blocks)')
+    parser.add_argument('--from-block', type=int, default=12_000_000)
+    parser.add_argument('--blocks', type=int, default=20)
+    parser.add_argument('--txns', type=int, default=200, help='txns per synthetic block (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    block_nums = range(args.from_block, args.from_block + args.blocks)
+    if args.endpoint:
+        raw_blocks = fetch_raw_blocks(args.endpoint, block_nums)
+    else:
+        raw_blocks = [synthetic_block(n, args.txns) for n in block_nums]
+
+    ntxns = sum(len(json.loads(r)['result']['transactions']) for r in raw_blocks)
+    print(f"{len(raw_blocks)} blocks, {ntxns / len(raw_blocks):.0f} txns per block, "
+          f"json decoder: {'orjson' if orjson else 'json'}")
+    timings = benchmark(raw_blocks)
+    for name, t in timings.items():
+        print(f"{name}: {t * 1000:.2f} ms per block")
+    print(f"speedup: {timings['web3'] / timings['raw']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+'''
+Time-bucketed gas price aggregates (per minute/hour/day) from scraped data.
+
+Joins txns with block timestamps and keeps, per bucket:
+count, number of blocks, min, max, txn-weighted mean and percentiles.
+
+Usage:
+
+    r = Resampler.load('resampled.pkl')   # or Resampler()
+    r.update(dataset.find_parts('data/gas_prices_*.csv'),
+             dataset.load_block_timestamps('data/blocks_*.csv'))
+    r.save('resampled.pkl')
+    df_1h = r.get('1h')
+
+`update` streams over parts in chunks and only reads files it hasn't seen
+(or that changed since), so keeping a year of history up to date is cheap.
+'''
+import logging
+import os
+
+import pandas as pd
+
+import dataset
+
+FREQS = {
+    '1m': 60,
+    '5m': 5 * 60,
+    '1h': 60 * 60,
+    '1d': 24 * 60 * 60,
+}
+
+DEFAULT_PERCENTILES = (10, 25, 50, 75, 90)
+
+# txns may be written slightly out of block order (see scrape.consoomer),
+# so a bucket is only finalized once we've seen data this many seconds past its end
+LATENESS = 5 * 60
+
+
+def aggregate(df, step, percentiles=DEFAULT_PERCENTILES):
+    '''
+    Aggregate txns in `df` (blockNum, timeStamp, gasPrice) into buckets of `step` seconds.
+    Index of the result is the unix timestamp at the start of each bucket.
+    '''
+    bucket = (df['timeStamp'] // step * step).rename('bucket')
+    g = df.groupby(bucket)['gasPrice']
+    out = g.agg(['count', 'min', 'max', 'mean'])
+    out.insert(1, 'blocks', df.groupby(bucket)['blockNum'].nunique())
+    if percentiles:
+        q = g.quantile([p / 100 for p in percentiles]).unstack()
+        q.columns = [f'p{p}' for p in percentiles]
+        out = out.join(q)
+    return out
+
+
+class Resampler(object):
+
+    def __init__(self, freqs=tuple(FREQS), percentiles=DEFAULT_PERCENTILES, lateness=LATENESS):
+        self.freqs = list(freqs)
+        self.percentiles = tuple(percentiles)
+        self.lateness = lateness
+        # finalized buckets per freq
+        self.aggs = {f: None for f in self.freqs}
+        # buckets starting before this timestamp are final, per freq
+        self.closed_until = {f: 0 for f in self.freqs}
+        # txns of buckets that aren't final yet (for the coarsest freq)
+        self.pending = pd.DataFrame({
+            'blockNum': pd.Series([], dtype='int64'),
+            'timeStamp': pd.Series([], dtype='int64'),
+            'gasPrice': pd.Series([], dtype='int64'),
+        })
+        # path -> (mtime, size, rows) of files already ingested
+        self.files = {}
+        # per freq, txns dropped because their bucket was already final
+        self.late_txns = {f: 0 for f in self.freqs}
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        '''Load saved state from `path`, or start fresh if there is none.'''
+        if os.path.exists(path):
+            return pd.read_pickle(path)
+        return cls(**kwargs)
+
+    def save(self, path):
+        pd.to_pickle(self, path)
+
+    def update(self, paths, block_timestamps, chunksize=dataset.CHUNKSIZE):
+        '''
+        Ingest the part files in `paths` that haven't been ingested yet,
+        in block order (see `dataset.iter_ordered_chunks`).
+
+        Files are assumed to only ever be appended to: of a file that
+        changed since it was ingested, only the rows past the ones already
+        ingested are read.
+        '''
+        new, grown = [], {}
+        for path in paths:
+            stat = os.stat(path)
+            seen = self.files.get(path)
+            if seen is None:
+                new.append(path)
+            elif seen[:2] != (stat.st_mtime, stat.st_size):
+                grown[path] = seen[2]
+
+        logging.info(f"Resampling {len(new)} new files, {len(grown)} changed files.")
+
+        usecols = ['blockNum', 'gasPrice']
+        index = dataset.build_index(new)
+        for chunk in dataset.iter_ordered_chunks(new, chunksize, usecols=usecols, index=index):
+            self._add(dataset.add_timestamps(chunk, block_timestamps))
+        for path, rows in zip(index['path'], index['rows']):
+            stat = os.stat(path)
+            self.files[path] = (stat.st_mtime, stat.st_size, int(rows))
+        # files without txns aren't in the index
+        for path in set(new) - set(index['path']):
+            stat = os.stat(path)
+            self.files[path] = (stat.st_mtime, stat.st_size, 0)
+
+        for path, skip in grown.items():
+            df = pd.concat(dataset.iter_chunks([path], chunksize, usecols=usecols), ignore_index=True)
+            rows = len(df)
+            if rows < skip:
+                logging.warning(f"{path} has fewer rows than when it was ingested; rebuild to pick up its changes.")
+            elif rows > skip:
+                df = df.iloc[skip:].sort_values('blockNum', kind='stable')
+                self._add(dataset.add_timestamps(df, block_timestamps))
+            stat = os.stat(path)
+            self.files[path] = (stat.st_mtime, stat.st_size, max(rows, skip))
+
+        return self
+
+    def _add(self, df):
+        # txns of buckets that have already been finalized are dropped,
+        # per freq (they may still count towards coarser buckets)
+        for f in self.freqs:
+            late = int((df['timeStamp'] < self.closed_until[f]).sum())
+            if late:
+                self.late_txns[f] += late
+                logging.warning(f"Ignoring {late} txns older than already finalized {f} buckets.")
+        df = df[df['timeStamp'] >= min(self.closed_until.values())]
+
+        pending = pd.concat([self.pending, df], ignore_index=True)
+        if pending.empty:
+            return
+        watermark = pending['timeStamp'].max() - self.lateness
+
+        for f in self.freqs:
+            step = FREQS[f]
+            # every bucket ending before the watermark is final
+            close_until = watermark // step * step
+            if close_until <= self.closed_until[f]:
+                continue
+            ts = pending['timeStamp']
+            rows = pending[(ts >= self.closed_until[f]) & (ts < close_until)]
+            if not rows.empty:
+                agg = aggregate(rows, step, self.percentiles)
+                self.aggs[f] = agg if self.aggs[f] is None else pd.concat([self.aggs[f], agg])
+            self.closed_until[f] = close_until
+
+        # only keep what some freq still needs
+        self.pending = pending[pending['timeStamp'] >= min(self.closed_until.values())]
+
+    def get(self, freq, start=None, end=None, include_open=True):
+        '''
+        Aggregates for `freq`, optionally limited to buckets in [start, end).
+        With `include_open`, buckets that may still change are included too.
+        '''
+        parts = [self.aggs[freq]] if self.aggs[freq] is not None else []
+        if include_open:
+            rows = self.pending[self.pending['timeStamp'] >= self.closed_until[freq]]
+            if not rows.empty:
+                parts.append(aggregate(rows, FREQS[freq], self.percentiles))
+        if not parts:
+            return pd.DataFrame()
+        df = pd.concat(parts)
+        if start is not None:
+            df = df[df.index >= start]
+        if end is not None:
+            df = df[df.index < end]
+        return df
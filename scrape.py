@@ -1,207 +1,614 @@
 #!/usr/local/bin/python3
+'''
+Scrape gas prices of (a sample of) Ethereum blocks.
+
+    python scrape.py --from 2020-08-01 --to 2020-09-01 --sample-percent 5
+    python scrape.py --from-block 10500000 --to-block 10600000 --sampling all --plan
+    python scrape.py --from 2021-01-01 --follow --endpoint http://node1:8545 --endpoint http://node2:8545
+
+Run with --help for all options.
+'''
+import argparse
 import csv
 from datetime import datetime, timedelta, timezone
 import logging
-import numpy as np
-from numpy.random import choice
-import pandas as pd
+import os
 import queue
+import random
+import re
 import threading
 import time
-from tqdm import tqdm
-from multiprocessing import Pool
 
 # uncomment to debug deadlock issues
 # from hanging_threads import start_monitoring
 # monitoring_thread = start_monitoring()
 
-####
-####
-# TODO:
-# - store unixtime of block number
-
+import fees
+from ratelimit import backoff_delay
 from util import LockedIterator, connect, get_first_eth_block_at
 
 from config import (
+    BLOCKS_PER_PART,
+    FINALITY_DEPTH,
+    MAX_REQUEUES,
+    NODE_IP_ADDR,
     NTHREADS,
+    RAW_BATCH_SIZE,
+    RPC_LATENCY,
+    RPC_MAX_CONCURRENCY,
+    RPC_REQUESTS_PER_SECOND,
     SAMPLE_PERCENT,
+    SKETCH_RELATIVE_ACCURACY,
+    TIMEZONE,
+    TXNS_PER_BLOCK,
 )
 
 logging.basicConfig(level=logging.INFO)
 
-WEB3 = connect()
+# NOTE: keep imports light and don't connect to a node at import time;
+# connections are made (and heavy modules imported) by the threads that need them
 
-to_unixtime = lambda dt: (dt - datetime(1970, 1, 1)).total_seconds()
+to_unixtime = lambda dt: dt.timestamp() if dt.tzinfo else (dt - datetime(1970, 1, 1)).total_seconds()
 dt_to_str = lambda dt: dt.strftime('%Y-%m-%d')
-do_select = lambda: choice([True, False], 1, p=[SAMPLE_PERCENT/100, 1 - SAMPLE_PERCENT/100])[0]
+do_select = lambda: random.random() < SAMPLE_PERCENT/100
+
+SAMPLING_MODES = ['systematic', 'random', 'all']
+OUTPUT_FORMATS = ['tsv', 'parquet', 'sketch']
+
+# in follow mode, only blocks at least FINALITY_DEPTH deep are scraped,
+# so nothing written can be reorged later
+FOLLOW_POLL_SECONDS = 15
 
 # keep track of progress via progress bar
 PBAR = None
 
-def scrape_prices(dt_from, dt_to=None):
+def scrape_prices(dt_from=None, dt_to=None, block_from=None, block_to=None,
+                  sampling='systematic', sample_percent=SAMPLE_PERCENT, chunk_size=2,
+                  endpoints=None, nthreads=NTHREADS, cache_path=None,
+                  outdir='.', name=None, output_format='tsv', blocks_per_part=BLOCKS_PER_PART,
+                  resume=False, follow=False, fee_mode=False, sketches=False,
+                  sketch_accuracy=SKETCH_RELATIVE_ACCURACY, raw=False):
+    '''
+    Scrape gas prices for a sample of blocks between dates `dt_from` and `dt_to`
+    (or block numbers `block_from` and `block_to`).
+
+    With `fee_mode`, whole blocks are fetched along with their receipts
+    and effective gas price, priority fee, base fee and gas used are
+    written too (see fees.py).
+
+    With `raw`, blocks are fetched with full txns, up to
+    `rawrpc.BATCH_SIZE` blocks per JSON-RPC batch request, bypassing web3
+    (see rawrpc.py).
 
-    if not dt_to:
-        dt_to = datetime.now() # for logging purposes
+    With `output_format='sketch'`, only a quantile sketch of each block's
+    gas prices is kept (see sketch.SketchTable), with `sketches` one is
+    written alongside every raw part.
+    '''
+    from tqdm import tqdm
+
+    if raw and fee_mode:
+        raise ValueError("fee mode needs receipts, which raw mode doesn't fetch")
+
+    endpoints = endpoints or [NODE_IP_ADDR]
+
+    if not name:
+        name = default_name(dt_from, dt_to, block_from, block_to, sample_percent)
 
-    outfile = f'gas_prices_{dt_to_str(dt_from)}_{dt_to_str(dt_to)}_{SAMPLE_PERCENT}%-sampling'
+    if not dt_to and block_to is None:
+        dt_to = datetime.now(timezone.utc)
+    outfile = os.path.join(outdir, name)
     logging.info(f'Writing to files prefixed with {outfile}')
 
-    block_nums = get_block_numbers(dt_from, dt_to, SAMPLE_PERCENT)
+    first_block, last_block = resolve_block_range(dt_from, dt_to, block_from, block_to, endpoints[0])
+    select = make_sampler(sampling, sample_percent, chunk_size, first_block)
+    block_nums = [b for b in range(first_block, last_block + 1) if select(b)]
+
+    first_part = 0
+    if resume:
+        done, first_part = scraped_blocks(outfile)
+        block_nums = [b for b in block_nums if b not in done]
+        logging.info(f"Resuming: {len(done)} blocks already scraped, continuing at part {first_part}.")
+
     logging.info(f"Querying {len(block_nums)} blocks.")
 
+    if follow:
+        block_nums = follow_block_numbers(block_nums, last_block + 1, select, endpoints[0], cache_path)
+
     ##
     ## producer - consoomer pattern
     ##
 
     txn_queue = queue.Queue()
     price_queue = queue.Queue()
+    blocks_table = BlocksTable(blocks_path(outfile))
 
     # initialize progress bar
     global PBAR
     # approximate total number of txns to process
-    txns_per_block = 170 # approximation
-    approx_total_txns = len(block_nums) * txns_per_block
+    approx_total_txns = None if follow else len(block_nums) * TXNS_PER_BLOCK
 
     logging.info(f"Approximately {approx_total_txns} txns to process.")
 
-    PBAR = tqdm(total=int(approx_total_txns))
+    PBAR = tqdm(total=approx_total_txns)
 
     # Create consumers
     # - consoomers read from txn hash queue and query transactions for prices
-    for i in range(NTHREADS - 1):
-        t = threading.Thread(target=consoomer, args=(i, txn_queue, price_queue))
+    # - spread over all endpoints
+    if nthreads is None:
+        nthreads = default_threads(len(endpoints))
+    for i in range(n_consumers(nthreads)):
+        endpoint = endpoints[i % len(endpoints)]
+        t = threading.Thread(target=consoomer, args=(i, txn_queue, price_queue, endpoint, cache_path, blocks_table, raw))
         # thread killed once main program exits
         t.daemon = True
         t.start()
 
-    # create producer
+    # run producer, in this thread so that its errors reach the caller
     # producer queries for block numbers and collects txn hashes
-    prod = threading.Thread(target=producer, args=(block_nums, txn_queue, price_queue, outfile))
-    prod.start()
-    prod.join()
+    # (in fee and raw mode, it just hands out block numbers)
+    try:
+        producer(
+            block_nums, txn_queue, price_queue, outfile,
+            endpoint=endpoints[0], cache_path=cache_path, blocks_per_part=blocks_per_part,
+            first_part=first_part, output_format=output_format, blocks_table=blocks_table,
+            whole_blocks=fee_mode or raw, sketch_accuracy=sketch_accuracy if sketches or output_format == 'sketch' else None,
+        )
+    finally:
+        blocks_table.close()
 
     logging.info("Done.")
 
-def get_block_numbers(dt_from, dt_to, sample_percent, chunk_size=2):
+def default_name(dt_from, dt_to, block_from, block_to, sample_percent):
     '''
-    Get a sample of block numbers between dates `from_dt` to `to_dt`.
-    - Only take a systematic sample of `sample_percent` from that range.
-    - We have a constraint to ensure blocks are sampled in a contiguous
-        chunk of `chunk_size`
+    Prefix of output files, e.g. gas_prices_2020-08-01_2021-01-20_5%-sampling.
+    Without an end, e.g. gas_prices_2020-08-01_5%-sampling, so that resuming
+    a scrape up to "now" on a later day finds the same files.
     '''
+    start = dt_to_str(dt_from) if block_from is None else f'b{block_from}'
+    if dt_to is None and block_to is None:
+        return f'gas_prices_{start}_{sample_percent:g}%-sampling'
+    end = dt_to_str(dt_to) if block_to is None else f'b{block_to}'
+    return f'gas_prices_{start}_{end}_{sample_percent:g}%-sampling'
 
-    block1 = get_first_eth_block_at(to_unixtime(dt_from))
-    block2 = get_first_eth_block_at(to_unixtime(dt_to))
-
-    # all block numbers in this date range
-    block_nums = list(range(block1['number'], block2['number'] + 1))
-
-    n = len(block_nums)
-    x = int(n * sample_percent / 100)
-
-    skip = n // (x // chunk_size)
-
-    first_blocks = range(block1['number'], block2['number'], skip)
-
-    all_block_nums = []
-    for b in first_blocks:
-        for i in range(chunk_size):
-            all_block_nums.append(b + i)
-
-    return all_block_nums
-
-def write_to_file(price_queue, outfile, part=None, ntxns=None):
-
-    with open(outfile, 'w') as f:
-
-        fieldnames = ['blockNum', 'txnID', 'gasPrice']
-        writer = csv.writer(f, delimiter='\t')
-
-        writer.writerow(fieldnames)
-
-        if not ntxns:
-            # write all txns
-            while not price_queue.empty():
-                block_num, txn_id, gas_price = price_queue.get()
-                txn_id = txn_id.hex() # convert to a string
-                writer.writerow([block_num, txn_id, gas_price])
-
-        else:
-            for _ in range(ntxns):
-                block_num, txn_id, gas_price = price_queue.get()
-                txn_id = txn_id.hex() # convert to a string
-                writer.writerow([block_num, txn_id, gas_price])
+def resolve_block_range(dt_from, dt_to, block_from, block_to, endpoint=NODE_IP_ADDR):
+    '''
+    First and last block number to scrape; dates are looked up on the node.
+    '''
+    if block_from is None:
+        block_from = get_first_eth_block_at(to_unixtime(dt_from), endpoint)['number']
+    if block_to is None:
+        block_to = get_first_eth_block_at(to_unixtime(dt_to), endpoint)['number']
+    return block_from, block_to
 
+def make_sampler(sampling, sample_percent, chunk_size, first_block, seed=0):
+    '''
+    Return a function telling whether a block number is part of the sample.
+    Blocks are always sampled in contiguous chunks of `chunk_size`.
 
-# Function called by the producer thread
-def producer(block_nums, txn_queue, price_queue, outfile):
-    web3 = connect()
+    - systematic: every `skip`-th chunk, starting at `first_block`
+    - random: each chunk with probability `sample_percent`; deterministic
+      for a given seed, so a resumed scrape picks the same blocks
+    - all: every block
+    '''
+    if sampling == 'all' or sample_percent >= 100:
+        return lambda b: True
 
-    for i, block_num in enumerate(block_nums):
+    if sampling == 'random':
+        return lambda b: random.Random(f'{seed}-{b // chunk_size}').random() < sample_percent / 100
 
-        block = web3.eth.getBlock(block_num)
-        date = datetime.utcfromtimestamp(block['timestamp'])
+    if sampling == 'systematic':
+        skip = max(chunk_size, round(chunk_size * 100 / sample_percent))
+        return lambda b: (b - first_block) % skip < chunk_size
 
-        for txnhash in block['transactions']:
-            # add all txns to txn queue
-            txn_queue.put((block_num, txnhash))
+    raise ValueError(f'unknown sampling mode {sampling}')
 
-        # write results periodically to file
-        # TODO: parameterize this
-        if i // 50 and i % 50 == 0:
-            part = i // 50
-            logging.info(f"Writing part {part} to file.")
-            write_to_file(price_queue, f"{outfile}_{part}.csv", part=part, ntxns=5000)
+def get_block_numbers(dt_from, dt_to, sample_percent, chunk_size=2):
+    '''
+    Get a sample of block numbers between dates `from_dt` to `to_dt`.
+    - Only take a systematic sample of `sample_percent` from that range.
+    - We have a constraint to ensure blocks are sampled in a contiguous
+        chunk of `chunk_size`
+    '''
+    first_block, last_block = resolve_block_range(dt_from, dt_to, None, None)
+    select = make_sampler('systematic', sample_percent, chunk_size, first_block)
+    return [b for b in range(first_block, last_block + 1) if select(b)]
 
+def follow_block_numbers(block_nums, start, select, endpoint=NODE_IP_ADDR, cache_path=None):
     '''
-    producer thread waits for consumer threads.
-    Maybe not the most elegant solution, but it does decouple
-    main thread from consumer threads so the main only needs
-    to keep track of (i.e. "join") the one producer thread.
+    Yield `block_nums`, then keep yielding sampled blocks from `start`
+    onwards as they get mined.
     '''
+    yield from block_nums
 
-    while not txn_queue.empty():
-        # wait for price queue to populate
-        # TODO: might still fail with lots of lag time on API calls
-        # TODO: approximate sleep time based on query params
-        time.sleep(30)
+    web3 = connect(endpoint, cache_path)
+    nxt = start
+    while True:
+        head = web3.eth.blockNumber - FINALITY_DEPTH
+        while nxt <= head:
+            if select(nxt):
+                yield nxt
+            nxt += 1
+        time.sleep(FOLLOW_POLL_SECONDS)
+
+def default_threads(n_endpoints):
+    '''
+    Consumers only ever have one request in flight each, so there's one
+    for every request the endpoints' concurrency limits allow; the limiter
+    then decides how many are actually in flight (see ratelimit.py).
+    '''
+    return 1 + RPC_MAX_CONCURRENCY * n_endpoints
 
-    logging.info("Transaction queue is empty.")
+def n_consumers(nthreads):
+    '''Consumer threads of a scrape with `nthreads` threads; one is the producer.'''
+    return max(1, nthreads - 1)
 
+def plan(n_blocks, nthreads=NTHREADS, n_endpoints=1, txns_per_block=TXNS_PER_BLOCK, fee_mode=False, raw=False):
     '''
-    NOTE: Just because the txn queue is empty,
-    doesn't mean the operation is over. The last
-    "popped" transaction might still be in
-    processing by one of the consumer threads.
-
-    To ensure this isn't the case, we make sure
-    the price queue hasn't changed since we last
-    checked.
+    Expected number of requests and run time of a scrape, as a dict.
+    '''
+    # fee mode: one request for the block, one for its receipts
+    # raw mode: just the block, with its txns
+    n_requests = n_blocks * (1 + (0 if raw else 1 if fee_mode else txns_per_block))
+    # bounded by both the rate limit of the endpoints and how many requests the threads keep in flight
+    # (only consumers make requests, one at a time each, up to the endpoints' concurrency limits)
+    if nthreads is None:
+        nthreads = default_threads(n_endpoints)
+    inflight = min(n_consumers(nthreads), RPC_MAX_CONCURRENCY * n_endpoints)
+    rps = min(RPC_REQUESTS_PER_SECOND * n_endpoints, inflight / RPC_LATENCY)
+    return {
+        'blocks': n_blocks,
+        'requests': n_requests,
+        'requests_per_second': rps,
+        'estimated_time': timedelta(seconds=round(n_requests / rps)),
+    }
+
+PART_EXTENSIONS = {'tsv': 'csv', 'parquet': 'parquet', 'sketch': 'sketch.npz'}
+
+def part_path(outfile, part, output_format='tsv'):
+    return f"{outfile}_{part}.{PART_EXTENSIONS[output_format]}"
+
+def sketch_path(path):
+    '''Path of the sketches of the raw part file at `path`.'''
+    return path.rsplit('.', 1)[0] + '.sketch.npz'
+
+def blocks_path(outfile):
+    '''Path of the table of block timestamps; see dataset.load_block_timestamps.'''
+    dirname, name = os.path.split(outfile)
+    return os.path.join(dirname, f"blocks_{name}.csv")
+
+def scraped_blocks(outfile):
     '''
-    qsize = None
-    if not qsize or qsize != price_queue.qsize():
-        # TODO: might still fail with lots of lag time on API calls
-        time.sleep(10)
+    Blocks of a previous run with prefix `outfile` whose txns have all been
+    written, and the number of the next part to write.
+    '''
+    import glob
+    import dataset
+
+    parts = glob.glob(f"{outfile}_*.csv") + glob.glob(f"{outfile}_*.parquet")
+    sketches = glob.glob(f"{outfile}_*.sketch.npz")
+    part_nums = [int(re.match(r'.*_(\d+)\.[\w.]+$', p).group(1)) for p in parts + sketches]
+    next_part = max(part_nums) + 1 if part_nums else 0
+
+    if not os.path.exists(blocks_path(outfile)):
+        return set(), next_part
+
+    expected = {}
+    with open(blocks_path(outfile)) as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            if row.get('txnCount'):
+                expected[int(row['blockNum'])] = int(row['txnCount'])
+
+    written = {}
+    for chunk in dataset.iter_chunks(parts, usecols=['blockNum']):
+        for b, n in chunk['blockNum'].value_counts().items():
+            written[b] = written.get(b, 0) + n
+    if not parts:
+        # sketch only output
+        table = dataset.load_sketches(sketches)
+        written = dict(zip(table.keys.tolist(), table.totals.tolist()))
+
+    done = {b for b, n in expected.items() if n == 0 or written.get(b, 0) >= n}
+    return done, next_part
+
+class BlocksTable(object):
+    '''
+    Table of block timestamps and txn counts (see dataset.load_block_timestamps),
+    appended to by whichever thread fetched the block.
+    '''
+    def __init__(self, path):
+        is_new = not os.path.exists(path)
+        self.file = open(path, 'a')
+        self.writer = csv.writer(self.file, delimiter='\t')
+        self.lock = threading.Lock()
+        if is_new:
+            self.writer.writerow(['blockNum', 'timeStamp', 'txnCount'])
+
+    def add(self, block_num, timestamp, txn_count):
+        with self.lock:
+            self.writer.writerow([block_num, timestamp, txn_count])
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def write_to_file(price_queue, outfile, part=None, ntxns=None, output_format='tsv', sketch_accuracy=None):
+
+    rows = []
+    if not ntxns:
+        # write all txns
+        while not price_queue.empty():
+            rows.append(price_queue.get())
+    else:
+        for _ in range(ntxns):
+            rows.append(price_queue.get())
+
+    # rows from fee mode have more columns
+    fieldnames = fees.FIELDNAMES if rows and len(rows[0]) > 3 else ['blockNum', 'txnID', 'gasPrice']
+    rows = [
+        # convert txn id to a string
+        (row[0], row[1] if isinstance(row[1], str) else row[1].hex()) + tuple(row[2:])
+        for row in rows
+    ]
+
+    if sketch_accuracy is not None:
+        import pandas as pd
+        from sketch import SketchTable
+        df = pd.DataFrame(rows, columns=fieldnames)
+        path = outfile if output_format == 'sketch' else sketch_path(outfile)
+        SketchTable.from_frame(df, sketch_accuracy).save(path)
+
+    if output_format == 'sketch':
+        return
+
+    if output_format == 'parquet':
+        # requires pyarrow
+        import pandas as pd
+        pd.DataFrame(rows, columns=fieldnames).to_parquet(outfile, index=False)
+        return
 
-    write_to_file(price_queue, f"{outfile}_{i // 50 + 1}.csv", part=part)
-    PBAR.close()
-    return
+    with open(outfile, 'w') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
 
-def consoomer(i, txn_queue, price_queue):
-    web3 = connect()
+# Function called by the producer thread
+def producer(block_nums, txn_queue, price_queue, outfile, endpoint=NODE_IP_ADDR, cache_path=None,
+             blocks_per_part=BLOCKS_PER_PART, first_part=0, output_format='tsv', blocks_table=None,
+             whole_blocks=False, sketch_accuracy=None):
+    web3 = connect(endpoint, cache_path)
+
+    part = first_part
+    try:
+        for i, block_num in enumerate(block_nums):
+
+            if whole_blocks:
+                # a txn hash of None means "the whole block"; see consoomer
+                txn_queue.put((block_num, None, 0))
+            else:
+                block = get_block(web3, block_num)
+                if block is None:
+                    # not in the blocks table, so --resume picks it up
+                    continue
+                blocks_table.add(block_num, block['timestamp'], len(block['transactions']))
+
+                for txnhash in block['transactions']:
+                    # add all txns to txn queue
+                    txn_queue.put((block_num, txnhash, 0))
+
+            # write results periodically to file
+            if i // blocks_per_part and i % blocks_per_part == 0:
+                # parts are cut by completed blocks, not txn counts, which
+                # vary too much (a quiet stretch would never fill a part)
+                txn_queue.join()
+                logging.info(f"Writing part {part} to file.")
+                write_to_file(
+                    price_queue, part_path(outfile, part, output_format), part=part,
+                    output_format=output_format, sketch_accuracy=sketch_accuracy,
+                )
+                blocks_table.flush()
+                part += 1
+    finally:
+        '''
+        producer waits for consumer threads, also when it fails,
+        so that the prices scraped since the last part aren't lost.
+
+        Consumers mark every txn as done (also ones they re-queue),
+        so once `join` returns, all prices are in the price queue.
+        '''
+        txn_queue.join()
+
+        logging.info("Transaction queue is empty.")
+
+        write_to_file(
+            price_queue, part_path(outfile, part, output_format), part=part,
+            output_format=output_format, sketch_accuracy=sketch_accuracy,
+        )
+        PBAR.close()
+
+def get_block(web3, block_num):
+    '''
+    Fetch a block, retrying errors the rate limiter doesn't (see ratelimit.py);
+    None if it keeps failing.
+    '''
+    for attempt in range(MAX_REQUEUES + 1):
+        try:
+            return web3.eth.getBlock(block_num)
+        except Exception as e:
+            if attempt == MAX_REQUEUES:
+                logging.error(f"Producer: giving up on block {block_num} ({e!r}).")
+                return None
+            logging.warning(f"Producer: block {block_num} failed ({e!r}), retrying.")
+            time.sleep(backoff_delay(attempt))
+
+def consoomer(i, txn_queue, price_queue, endpoint=NODE_IP_ADDR, cache_path=None, blocks_table=None, raw=False):
+    # rate limiting and retries are handled by the connection's middleware
+    web3 = connect(endpoint, cache_path)
+    if raw:
+        import rawrpc
     while True:
-        if not txn_queue.empty():
-            block_num, txnhash = txn_queue.get()
-            txn = web3.eth.getTransaction(txnhash)
-            t = (block_num, txnhash, txn['gasPrice'])
+        block_num, txnhash, attempts = txn_queue.get()
+        if raw:
+            # whole blocks only; fetch as many as fit in one JSON-RPC batch
+            items = [(block_num, txnhash, attempts)]
+            while len(items) < rawrpc.BATCH_SIZE:
+                try:
+                    items.append(txn_queue.get_nowait())
+                except queue.Empty:
+                    break
+            consume_raw(i, items, txn_queue, price_queue, endpoint, blocks_table)
+            continue
+
+        what = f"block {block_num}" if txnhash is None else txnhash.hex()
+        try:
+            if txnhash is None:
+                # fee mode: all txns of the block at once
+                timestamp, rows = fees.get_block_fees(web3, block_num, endpoint)
+            else:
+                txn = web3.eth.getTransaction(txnhash)
+                rows = [(block_num, txnhash, txn['gasPrice'])]
+        except Exception as e:
+            # don't let one bad call kill the thread; put the work back
+            if attempts < MAX_REQUEUES:
+                logging.warning(f"Consumer {i}: {what} failed ({e!r}), re-queueing.")
+                txn_queue.put((block_num, txnhash, attempts + 1))
+            else:
+                logging.error(f"Consumer {i}: giving up on {what} ({e!r}).")
+                PBAR.update(1)
+            txn_queue.task_done()
+            continue
+        if txnhash is None:
+            blocks_table.add(block_num, timestamp, len(rows))
+        for t in rows:
+            price_queue.put(t)
+        txn_queue.task_done()
+        # update progress bar
+        PBAR.update(len(rows))
+
+def consume_raw(i, items, txn_queue, price_queue, endpoint, blocks_table):
+    '''Fetch the blocks of queue `items` in one batch (see rawrpc.py) and queue their prices.'''
+    import rawrpc
+    from ratelimit import is_throttled
+    try:
+        prices = rawrpc.get_block_prices(endpoint, [block_num for block_num, _, _ in items])
+    except Exception as e:
+        if len(items) > 1 and not is_throttled(e):
+            # one bad block fails the whole batch; don't let it take the others down with it
+            logging.warning(f"Consumer {i}: batch of {len(items)} blocks failed ({e!r}), fetching them one by one.")
+            for item in items:
+                consume_raw(i, [item], txn_queue, price_queue, endpoint, blocks_table)
+            return
+        for block_num, txnhash, attempts in items:
+            if attempts < MAX_REQUEUES:
+                logging.warning(f"Consumer {i}: block {block_num} failed ({e!r}), re-queueing.")
+                txn_queue.put((block_num, txnhash, attempts + 1))
+            else:
+                logging.error(f"Consumer {i}: giving up on block {block_num} ({e!r}).")
+                PBAR.update(1)
+            txn_queue.task_done()
+        return
+    for block_num, _, _ in items:
+        timestamp, rows = prices[block_num]
+        blocks_table.add(block_num, timestamp, len(rows))
+        for t in rows:
             price_queue.put(t)
-            # update progress bar
-            PBAR.update(1)
-            # TODO: add a sleep() if rps becomes an issue
+        txn_queue.task_done()
+        PBAR.update(len(rows))
+
+def thread_count(s):
+    n = int(s)
+    if n < 2:
+        raise argparse.ArgumentTypeError('need at least 2 threads: a producer and a consumer')
+    return n
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Scrape historical gas prices from an Ethereum node.')
+
+    group = parser.add_argument_group('range')
+    group.add_argument('--from', dest='dt_from', default='2020-08-01',
+                       help='start date, YYYY-MM-DD[THH:MM] (default: %(default)s)')
+    group.add_argument('--to', dest='dt_to', help='end date (default: now)')
+    group.add_argument('--from-block', type=int, help='start block; overrides --from')
+    group.add_argument('--to-block', type=int, help='end block; overrides --to')
+    group.add_argument('--timezone', default=TIMEZONE, help='timezone of --from/--to (default: %(default)s)')
+
+    group = parser.add_argument_group('sampling')
+    group.add_argument('--sampling', choices=SAMPLING_MODES, default='systematic')
+    group.add_argument('--sample-percent', type=float, default=SAMPLE_PERCENT,
+                       help='percentage of blocks to scrape (default: %(default)s)')
+    group.add_argument('--chunk-size', type=int, default=2,
+                       help='sample blocks in contiguous chunks of this many blocks (default: %(default)s)')
+
+    group = parser.add_argument_group('node')
+    group.add_argument('--endpoint', action='append', dest='endpoints',
+                       help='node url; repeat to spread requests over several nodes (default: $NODE_IP_ADDR)')
+    group.add_argument('--threads', type=thread_count, default=NTHREADS,
+                       help='threads, including the producer; at least 2 (default: enough that the '
+                            'adaptive concurrency limit of each endpoint is what caps requests in flight)')
+    group.add_argument('--cache', dest='cache_path', help='cache node responses in this file')
+    group.add_argument('--raw', action='store_true',
+                       help=f'fetch whole blocks with raw JSON-RPC instead of web3, in batches of up to {RAW_BATCH_SIZE} blocks per request (not cached)')
+
+    group = parser.add_argument_group('output')
+    group.add_argument('--outdir', default='.')
+    group.add_argument('--name', help='prefix of output files (default: derived from range and sampling)')
+    group.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS, default='tsv',
+                       help='tsv (.csv files, default), parquet (requires pyarrow) '
+                            'or sketch (only approximate per block gas price quantiles, see sketch.py)')
+    group.add_argument('--sketches', action='store_true',
+                       help='also write per block quantile sketches alongside the raw parts')
+    group.add_argument('--sketch-accuracy', type=float, default=SKETCH_RELATIVE_ACCURACY,
+                       help='relative accuracy of sketched quantiles (default: %(default)s)')
+    group.add_argument('--blocks-per-part', type=int, default=BLOCKS_PER_PART,
+                       help='write a part file every this many blocks (default: %(default)s)')
+    group.add_argument('--fees', dest='fee_mode', action='store_true',
+                       help='also write effective gas price, priority fee, base fee and gas used (from receipts)')
+
+    group = parser.add_argument_group('mode')
+    group.add_argument('--resume', action='store_true', help='skip blocks already written by a previous run with the same name')
+    group.add_argument('--follow', action='store_true', help='keep scraping new blocks as they are mined')
+    group.add_argument('--plan', action='store_true', help="report what would be scraped and how long it'd take, then exit")
+
+    return parser.parse_args(argv)
+
+def parse_date(s, tz):
+    if s is None:
+        return None
+    from zoneinfo import ZoneInfo
+    return datetime.fromisoformat(s).replace(tzinfo=ZoneInfo('UTC' if tz.lower() == 'utc' else tz))
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    dt_from = parse_date(args.dt_from, args.timezone)
+    # no end date means "now"; left out of the default name, see default_name
+    dt_to = parse_date(args.dt_to, args.timezone)
+    endpoints = args.endpoints or [NODE_IP_ADDR]
+
+    if args.plan:
+        first_block, last_block = resolve_block_range(
+            dt_from, dt_to or datetime.now(timezone.utc), args.from_block, args.to_block, endpoints[0])
+        select = make_sampler(args.sampling, args.sample_percent, args.chunk_size, first_block)
+        n_blocks = sum(1 for b in range(first_block, last_block + 1) if select(b))
+        name = args.name or default_name(dt_from, dt_to, args.from_block, args.to_block, args.sample_percent)
+        if args.resume:
+            n_blocks -= len(scraped_blocks(os.path.join(args.outdir, name))[0])
+        print(f"blocks {first_block} - {last_block}, {args.sampling} sampling at {args.sample_percent}%")
+        for k, v in plan(n_blocks, args.threads, len(endpoints), fee_mode=args.fee_mode, raw=args.raw).items():
+            print(f"{k}: {v}")
+        return
+
+    scrape_prices(
+        dt_from=dt_from, dt_to=dt_to, block_from=args.from_block, block_to=args.to_block,
+        sampling=args.sampling, sample_percent=args.sample_percent, chunk_size=args.chunk_size,
+        endpoints=endpoints, nthreads=args.threads, cache_path=args.cache_path,
+        outdir=args.outdir, name=args.name, output_format=args.output_format,
+        blocks_per_part=args.blocks_per_part, resume=args.resume, follow=args.follow,
+        fee_mode=args.fee_mode, sketches=args.sketches, sketch_accuracy=args.sketch_accuracy, raw=args.raw,
+    )
 
 if __name__ == '__main__':
-
-    from_datestr = '2020-08-01'
-    dt_from = datetime.strptime(from_datestr, "%Y-%m-%d")
-    #df_from = dt_to - timedelta(minutes=30)
-    scrape_prices(dt_from=dt_from, dt_to=datetime.now())
+    main()
@@ -0,0 +1,403 @@
+'''
+Mergeable quantile sketch with a relative error guarantee (DDSketch).
+
+Values are counted in logarithmic buckets: with relative accuracy `a`,
+every quantile estimate is within a factor of (1 +/- a) of a true value
+at that rank. Gas prices span many orders of magnitude, which is exactly
+what relative (rather than rank) error is good at, and bucket counts add
+up, so sketches of different chunks/blocks/files merge exactly.
+
+At 1% accuracy the whole range of gas prices ever seen fits in ~1k
+buckets, no matter how many txns are added.
+
+    s = QuantileSketch(0.01)
+    s.add(df['gasPrice'].values)
+    s.merge(other)
+    s.quantile(0.5), s.rank(50 * 10**9)
+
+`SketchTable` keeps one sketch per block (or per time bucket) in flat
+arrays. At 1% accuracy a block's prices take a few hundred bytes instead
+of tens of KB of raw txns, and percentiles/ranks of every block are
+answered at once:
+
+    t = SketchTable.from_frame(df)          # or SketchTable.load(path)
+    t.percentile(50)                        # median of every block
+    t.rank(50 * 10**9, keys=[b1, b2])       # fraction of txns <= 50 gwei
+    time_buckets(t, block_timestamps, 3600).percentile(90)
+'''
+import logging
+import math
+
+import numpy as np
+
+from config import SKETCH_RELATIVE_ACCURACY as DEFAULT_RELATIVE_ACCURACY
+
+
+class QuantileSketch(object):
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # counts[i] is the count of bucket `offset + i`
+        self.counts = np.zeros(0, dtype='int64')
+        self.offset = 0
+        # values <= 0 (e.g. zero gas price txns) are counted separately
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _keys(self, values):
+        return np.ceil(np.log(values) / self.log_gamma).astype('int64')
+
+    def _value(self, key):
+        # midpoint of the bucket (gamma^(k-1), gamma^k], in relative terms
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def _extend(self, lo, hi):
+        '''Make room for buckets lo..hi.'''
+        if not len(self.counts):
+            self.offset = lo
+            self.counts = np.zeros(hi - lo + 1, dtype='int64')
+            return
+        new_lo = min(lo, self.offset)
+        new_hi = max(hi, self.offset + len(self.counts) - 1)
+        if new_lo == self.offset and new_hi == self.offset + len(self.counts) - 1:
+            return
+        counts = np.zeros(new_hi - new_lo + 1, dtype='int64')
+        counts[self.offset - new_lo:self.offset - new_lo + len(self.counts)] = self.counts
+        self.counts, self.offset = counts, new_lo
+
+    def add(self, values):
+        '''Add an array (or scalar) of values.'''
+        values = np.asarray(values, dtype='float64').ravel()
+        if not len(values):
+            return self
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        if len(positive):
+            keys = self._keys(positive)
+            lo, hi = int(keys.min()), int(keys.max())
+            self._extend(lo, hi)
+            self.counts[lo - self.offset:hi - self.offset + 1] += np.bincount(keys - lo)
+        return self
+
+    def merge(self, other):
+        '''Add all values of `other` (with the same accuracy) to this sketch.'''
+        assert self.gamma == other.gamma, 'can only merge sketches with the same accuracy'
+        if other.count == 0:
+            return self
+        if len(other.counts):
+            lo, hi = other.offset, other.offset + len(other.counts) - 1
+            self._extend(lo, hi)
+            self.counts[lo - self.offset:hi - self.offset + 1] += other.counts
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        '''
+        Estimate of the `q`-quantile (0 <= q <= 1), or an array of them for an array of `q`s.
+        '''
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else math.nan
+        q = np.asarray(q, dtype='float64')
+        rank = q * (self.count - 1)
+        cum = self.zero_count + np.cumsum(self.counts)
+        idx = np.searchsorted(cum, rank, side='right')
+        idx = np.minimum(idx, len(self.counts) - 1)
+        values = np.where(
+            rank < self.zero_count,
+            min(self.min, 0),
+            self._value(self.offset + idx) if len(self.counts) else 0,
+        )
+        # exact at the extremes
+        values = np.clip(values, self.min, self.max)
+        values = np.where(q <= 0, self.min, np.where(q >= 1, self.max, values))
+        return values if values.ndim else float(values)
+
+    def percentile(self, p):
+        '''Like `quantile`, with `p` in 0..100.'''
+        return self.quantile(np.asarray(p) / 100)
+
+    def rank(self, value):
+        '''Estimated fraction of values <= `value`.'''
+        if self.count == 0:
+            return math.nan
+        value = np.asarray(value, dtype='float64')
+        below = np.where(value >= 0, self.zero_count, 0)
+        cum = np.concatenate([[0], np.cumsum(self.counts)])
+        with np.errstate(divide='ignore'):
+            keys = np.where(value > 0, self._keys(np.maximum(value, 1e-300)), self.offset - 1)
+        n = cum[np.clip(keys - self.offset + 1, 0, len(self.counts))]
+        result = (below + np.where(value > 0, n, 0)) / self.count
+        return result if result.ndim else float(result)
+
+
+class SketchTable(object):
+    '''
+    Quantile sketches of many keys (block numbers, or time buckets) stored
+    column-wise in a few flat arrays, i.e. a compact alternative to keeping
+    raw txns when only percentiles are needed.
+
+    Only non-empty buckets are stored: entries `starts[i]:starts[i + 1]`
+    of `buckets`/`counts` belong to `keys[i]`, with bucket indices
+    relative to the sketch's `offsets[i]`.
+
+    Keys may appear more than once while building (e.g. a block split
+    across two scraped parts); `concat` merges them.
+    '''
+
+    def __init__(self, relative_accuracy, keys, offsets, starts, buckets, counts, zero_counts, totals, mins, maxs):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.keys = keys
+        self.offsets = offsets
+        self.starts = starts
+        self.buckets = buckets
+        self.counts = counts
+        self.zero_counts = zero_counts
+        self.totals = totals
+        self.mins = mins
+        self.maxs = maxs
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_frame(cls, df, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, key='blockNum', column='gasPrice'):
+        '''One sketch per distinct `key` of the txns in `df`.'''
+        keys = df[key].to_numpy(dtype='int64')
+        values = df[column].to_numpy(dtype='float64')
+        log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        positive = values > 0
+        with np.errstate(divide='ignore'):
+            buckets = np.ceil(np.log(np.where(positive, values, 1)) / log_gamma).astype('int64')
+        return cls._from_entries(
+            relative_accuracy,
+            entry_keys=keys[positive], entry_buckets=buckets[positive], entry_counts=np.ones(positive.sum(), dtype='int64'),
+            keys=keys, zero_counts=(~positive).astype('int64'), totals=np.ones(len(keys), dtype='int64'),
+            mins=values, maxs=values,
+        )
+
+    @classmethod
+    def _from_entries(cls, relative_accuracy, entry_keys, entry_buckets, entry_counts, keys, zero_counts, totals, mins, maxs):
+        '''
+        Build a table from (key, absolute bucket, count) entries and per-row
+        key stats, adding up everything that shares a key.
+        '''
+        # per key stats
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        n = len(uniq)
+        zero = np.bincount(inverse, weights=zero_counts, minlength=n).astype('int64')
+        total = np.bincount(inverse, weights=totals, minlength=n).astype('int64')
+        lo = np.full(n, np.inf)
+        hi = np.full(n, -np.inf)
+        np.minimum.at(lo, inverse, mins)
+        np.maximum.at(hi, inverse, maxs)
+
+        # sum counts of equal (key, bucket) pairs
+        order = np.lexsort((entry_buckets, entry_keys))
+        ek, eb, ec = entry_keys[order], entry_buckets[order], entry_counts[order]
+        new = np.ones(len(ek), dtype=bool)
+        new[1:] = (ek[1:] != ek[:-1]) | (eb[1:] != eb[:-1])
+        idx = np.flatnonzero(new)
+        ek, eb = ek[idx], eb[idx]
+        ec = np.add.reduceat(ec, idx) if len(idx) else ec[:0]
+
+        pos = np.searchsorted(uniq, ek)
+        starts = np.zeros(n + 1, dtype='int64')
+        starts[1:] = np.cumsum(np.bincount(pos, minlength=n))
+        offsets = np.zeros(n, dtype='int64')
+        has = starts[1:] > starts[:-1]
+        offsets[has] = eb[starts[:-1][has]]
+        rel = eb - np.repeat(offsets, np.diff(starts))
+
+        return cls(
+            relative_accuracy, uniq, offsets, starts,
+            rel.astype('int32'), ec.astype('uint32' if not len(ec) or ec.max() < 2 ** 32 else 'int64'),
+            zero, total, lo, hi,
+        )
+
+    def _entries(self):
+        seg = np.repeat(np.arange(len(self.keys)), np.diff(self.starts))
+        return self.keys[seg], self.offsets[seg] + self.buckets, self.counts.astype('int64')
+
+    @classmethod
+    def concat(cls, tables):
+        '''Combine tables, merging sketches with the same key.'''
+        tables = [t for t in tables if len(t)]
+        if not tables:
+            return cls.empty()
+        entries = [t._entries() for t in tables]
+        return cls._from_entries(
+            tables[0].relative_accuracy,
+            *(np.concatenate([e[i] for e in entries]) for i in range(3)),
+            *(np.concatenate([getattr(t, a) for t in tables]) for a in ['keys', 'zero_counts', 'totals', 'mins', 'maxs']),
+        )
+
+    def regroup(self, new_keys):
+        '''
+        Merge sketches into coarser groups; `new_keys[i]` is the group of `keys[i]`,
+        e.g. the start of the time bucket a block belongs to.
+        '''
+        new_keys = np.asarray(new_keys, dtype='int64')
+        ek, eb, ec = self._entries()
+        return self._from_entries(
+            self.relative_accuracy,
+            new_keys[np.searchsorted(self.keys, ek)], eb, ec,
+            new_keys, self.zero_counts, self.totals, self.mins, self.maxs,
+        )
+
+    def take(self, idx):
+        '''Table of the sketches at positions `idx` only.'''
+        idx = np.asarray(idx, dtype='int64')
+        entries = np.concatenate([np.arange(self.starts[i], self.starts[i + 1]) for i in idx]) if len(idx) else np.zeros(0, dtype='int64')
+        starts = np.zeros(len(idx) + 1, dtype='int64')
+        starts[1:] = np.cumsum(self.starts[idx + 1] - self.starts[idx])
+        return SketchTable(
+            self.relative_accuracy, self.keys[idx], self.offsets[idx], starts,
+            self.buckets[entries], self.counts[entries],
+            self.zero_counts[idx], self.totals[idx], self.mins[idx], self.maxs[idx],
+        )
+
+    @classmethod
+    def empty(cls, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        i, f = np.zeros(0, dtype='int64'), np.zeros(0)
+        return cls(relative_accuracy, i, i, np.zeros(1, dtype='int64'), i.astype('int32'), i.astype('uint32'), i, i, f, f)
+
+    def sketch(self, key):
+        '''The `QuantileSketch` of `key`.'''
+        i = self._index(key)
+        s = QuantileSketch(self.relative_accuracy)
+        a, b = self.starts[i], self.starts[i + 1]
+        if b > a:
+            s.offset = int(self.offsets[i])
+            s.counts = np.zeros(int(self.buckets[b - 1]) + 1, dtype='int64')
+            s.counts[self.buckets[a:b]] = self.counts[a:b]
+        s.zero_count = int(self.zero_counts[i])
+        s.count = int(self.totals[i])
+        s.min, s.max = float(self.mins[i]), float(self.maxs[i])
+        return s
+
+    def merged(self, first_key=None, last_key=None):
+        '''One sketch of all keys in [first_key, last_key].'''
+        lo = 0 if first_key is None else np.searchsorted(self.keys, first_key, side='left')
+        hi = len(self.keys) if last_key is None else np.searchsorted(self.keys, last_key, side='right')
+        if lo >= hi:
+            return QuantileSketch(self.relative_accuracy)
+        ek, eb, ec = self._entries()
+        sl = slice(self.starts[lo], self.starts[hi])
+        part = self._from_entries(
+            self.relative_accuracy,
+            np.zeros(sl.stop - sl.start, dtype='int64'), eb[sl], ec[sl],
+            np.zeros(hi - lo, dtype='int64'), self.zero_counts[lo:hi], self.totals[lo:hi],
+            self.mins[lo:hi], self.maxs[lo:hi],
+        )
+        return part.sketch(0)
+
+    def _index(self, key):
+        i = np.searchsorted(self.keys, key)
+        if i >= len(self.keys) or self.keys[i] != key:
+            raise KeyError(key)
+        return i
+
+    def _indices(self, keys):
+        if keys is None:
+            return np.arange(len(self.keys))
+        return np.array([self._index(k) for k in np.atleast_1d(keys)], dtype='int64')
+
+    def quantile(self, q, keys=None):
+        '''
+        Estimated `q`-quantile of every sketch (or of `keys`), as an array.
+        '''
+        idx = self._indices(keys)
+        if q <= 0:
+            return self.mins[idx].copy()
+        if q >= 1:
+            return self.maxs[idx].copy()
+        zero = self.zero_counts[idx]
+        rank = q * (self.totals[idx] - 1)
+        first, end = self.starts[idx], self.starts[idx + 1]
+
+        # entry holding `rank`, searched over the cumulative counts of all sketches at once
+        cum = np.concatenate([[0], np.cumsum(self.counts, dtype='int64')])
+        pos = np.searchsorted(cum, cum[first] + (rank - zero), side='right') - 1
+        pos = np.clip(pos, first, np.maximum(end - 1, first))
+        buckets = np.append(self.buckets, 0)  # padding for sketches without entries
+        key = self.offsets[idx] + np.where(end > first, buckets[pos], 0)
+
+        values = np.where(rank < zero, np.minimum(self.mins[idx], 0), 2 * self.gamma ** key / (self.gamma + 1))
+        return np.clip(values, self.mins[idx], self.maxs[idx])
+
+    def percentile(self, p, keys=None):
+        '''Like `quantile`, with `p` in 0..100.'''
+        return self.quantile(p / 100, keys)
+
+    def rank(self, values, keys=None):
+        '''
+        Estimated fraction of values <= `values[i]` in the sketch of `keys[i]`
+        (or of every key), as an array.
+        '''
+        idx = self._indices(keys)
+        values = np.broadcast_to(np.asarray(values, dtype='float64'), idx.shape)
+        with np.errstate(divide='ignore'):
+            vkeys = np.ceil(np.log(np.maximum(values, 1e-300)) / self.log_gamma).astype('int64')
+
+        # entries of a sketch are sorted by bucket, so a global searchsorted on
+        # (sketch, bucket) pairs finds how many entries are <= each value
+        seg = np.repeat(np.arange(len(self.keys)), np.diff(self.starts))
+        combined = seg * 2 ** 32 + self.buckets
+        rel = np.clip(vkeys - self.offsets[idx], -1, 2 ** 31 - 1)
+        end = np.searchsorted(combined, idx * 2 ** 32 + rel, side='right')
+        cum = np.concatenate([[0], np.cumsum(self.counts, dtype='int64')])
+        n = cum[np.maximum(end, self.starts[idx])] - cum[self.starts[idx]]
+
+        below = np.where(values >= 0, self.zero_counts[idx], 0) + np.where(values > 0, n, 0)
+        return below / np.maximum(self.totals[idx], 1)
+
+    def to_frame(self, percentiles=(0, 25, 50, 75, 100)):
+        '''Per key count, min, max and approximate percentiles.'''
+        import pandas as pd
+        df = pd.DataFrame({'count': self.totals, 'min': self.mins, 'max': self.maxs}, index=pd.Index(self.keys, name='key'))
+        for p in percentiles:
+            df[f'p{p}'] = self.percentile(p)
+        return df
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            relative_accuracy=np.array(self.relative_accuracy),
+            keys=self.keys, offsets=self.offsets, starts=self.starts,
+            buckets=self.buckets, counts=self.counts,
+            zero_counts=self.zero_counts, totals=self.totals, mins=self.mins, maxs=self.maxs,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(
+            float(data['relative_accuracy']),
+            *(data[a] for a in ['keys', 'offsets', 'starts', 'buckets', 'counts', 'zero_counts', 'totals', 'mins', 'maxs']),
+        )
+
+
+def time_buckets(table, block_timestamps, step):
+    '''
+    Merge the per block sketches of `table` into sketches of `step` second
+    time buckets, keyed by the bucket's start timestamp.
+    `block_timestamps` is a blockNum -> timeStamp Series (see dataset.load_block_timestamps).
+    '''
+    ts = block_timestamps.reindex(table.keys).to_numpy()
+    known = ~np.isnan(ts.astype('float64'))
+    if not known.all():
+        logging.warning(f"{(~known).sum()} blocks without a timestamp, skipping them.")
+        table, ts = table.take(np.flatnonzero(known)), ts[known]
+    return table.regroup(ts.astype('int64') // step * step)
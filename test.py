@@ -1,8 +1,39 @@
+import copy
+from datetime import datetime, timezone
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+from types import SimpleNamespace
 import unittest
 
+import numpy as np
+import pandas as pd
+import requests
+
+import analysis
+import cache
+import dataset
+import fees
+import inclusion
+import memo
+import ratelimit
+import rawrpc
+import resample
+import scrape
+import sketch
 import util
 
+# notebook helpers are imported from their own directories
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'airnode_simulation'))
+import _replay
+import _schedule
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'live-testing', 'notebooks'))
+import _utils
+
 class TestGetFirstEthBlockAt(unittest.TestCase):
     
     def setUp(self):
@@ -17,5 +48,963 @@ class TestGetFirstEthBlockAt(unittest.TestCase):
         block_after = self.web3.eth.getBlock(block['number'] + 1)
         self.assertTrue(block['timestamp'] <= ts and ts < block_after['timestamp'])
 
+class TestImports(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        """
+        Importing the scraper doesn't pull in web3/pandas or connect to a node
+        """
+        code = "import sys, scrape, util; assert not {'web3', 'pandas', 'numpy'} & set(sys.modules)"
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+class TestScrape(unittest.TestCase):
+
+    def test_samplers(self):
+        for mode in ['systematic', 'random']:
+            select = scrape.make_sampler(mode, 5, 2, 1000)
+            blocks = [b for b in range(1000, 101000) if select(b)]
+            self.assertAlmostEqual(len(blocks) / 100000, 0.05, delta=0.01)
+            # sampled in contiguous pairs
+            self.assertTrue(all(b + 1 in blocks or b - 1 in blocks for b in blocks[:100]))
+        select = scrape.make_sampler('all', 5, 2, 1000)
+        self.assertTrue(all(select(b) for b in range(1000, 1010)))
+
+    def test_resume(self):
+        """
+        Only blocks whose txns were all written count as scraped
+        """
+        with tempfile.TemporaryDirectory() as dirname:
+            outfile = os.path.join(dirname, 'gas_prices_b1_b9_5%-sampling')
+            with open(scrape.blocks_path(outfile), 'w') as f:
+                f.write('blockNum\ttimeStamp\ttxnCount\n1\t100\t2\n2\t110\t0\n3\t120\t2\n')
+            with open(scrape.part_path(outfile, 0), 'w') as f:
+                f.write('blockNum\ttxnID\tgasPrice\n1\t0xa\t5\n1\t0xb\t6\n3\t0xc\t7\n')
+            done, next_part = scrape.scraped_blocks(outfile)
+            self.assertEqual(done, {1, 2})
+            self.assertEqual(next_part, 1)
+
+    def test_sketch_output(self):
+        """
+        Sketch only parts are written and count towards resuming
+        """
+        with tempfile.TemporaryDirectory() as dirname:
+            outfile = os.path.join(dirname, 'gas_prices_b1_b9_5%-sampling')
+            with open(scrape.blocks_path(outfile), 'w') as f:
+                f.write('blockNum\ttimeStamp\ttxnCount\n1\t100\t2\n3\t120\t2\n')
+            q = queue.Queue()
+            for row in [(1, '0xa', 5), (1, '0xb', 6), (3, '0xc', 7)]:
+                q.put(row)
+            scrape.write_to_file(q, scrape.part_path(outfile, 0, 'sketch'), output_format='sketch', sketch_accuracy=0.01)
+            table = dataset.load_sketches(f'{outfile}_*.sketch.npz')
+            self.assertEqual(table.keys.tolist(), [1, 3])
+            self.assertEqual(scrape.scraped_blocks(outfile), ({1}, 1))
+
+    def test_sparse_blocks(self):
+        """
+        Parts are written for blocks with few txns too
+        """
+        def consumer(txn_queue, price_queue, blocks_table):
+            while True:
+                block_num, _, _ = txn_queue.get()
+                blocks_table.add(block_num, 100 + block_num, 1)
+                price_queue.put((block_num, f'0x{block_num:x}', 5))
+                txn_queue.task_done()
+
+        with tempfile.TemporaryDirectory() as dirname:
+            outfile = os.path.join(dirname, 'gas_prices_b1_b9_5%-sampling')
+            txn_queue, price_queue = queue.Queue(), queue.Queue()
+            blocks_table = scrape.BlocksTable(scrape.blocks_path(outfile))
+            scrape.PBAR = SimpleNamespace(close=lambda: None)
+            threading.Thread(target=consumer, args=(txn_queue, price_queue, blocks_table), daemon=True).start()
+            p = threading.Thread(target=scrape.producer, daemon=True, args=(range(1, 10), txn_queue, price_queue, outfile), kwargs={
+                'endpoint': 'http://localhost:8545', 'blocks_per_part': 3, 'blocks_table': blocks_table, 'whole_blocks': True})
+            p.start()
+            p.join(timeout=10)
+            self.assertFalse(p.is_alive())
+            blocks_table.close()
+            df = pd.concat(pd.read_csv(path, sep='\t') for path in dataset.find_parts(f'{outfile}_*.csv'))
+            self.assertEqual(sorted(df['blockNum']), list(range(1, 10)))
+
+    def test_producer_errors(self):
+        """
+        Failing blocks are retried or skipped, and a failing producer still writes its last part
+        """
+        calls = []
+        def get_block(block_num):
+            calls.append(block_num)
+            if block_num == 2 or (block_num == 3 and calls.count(3) == 1):
+                raise ValueError('oops')
+            return {'timestamp': 100 + block_num, 'transactions': [f'0x{block_num:x}']}
+
+        def block_nums():
+            yield from range(1, 5)
+            raise RuntimeError('node went away')
+
+        def consumer(txn_queue, price_queue):
+            while True:
+                block_num, txnhash, _ = txn_queue.get()
+                price_queue.put((block_num, txnhash, 5))
+                txn_queue.task_done()
+
+        with tempfile.TemporaryDirectory() as dirname:
+            outfile = os.path.join(dirname, 'gas_prices_b1_b9_5%-sampling')
+            txn_queue, price_queue = queue.Queue(), queue.Queue()
+            blocks_table = scrape.BlocksTable(scrape.blocks_path(outfile))
+            scrape.PBAR = SimpleNamespace(close=lambda: None)
+            threading.Thread(target=consumer, args=(txn_queue, price_queue), daemon=True).start()
+            _connect, _backoff = scrape.connect, scrape.backoff_delay
+            scrape.connect = lambda endpoint, cache_path: SimpleNamespace(eth=SimpleNamespace(getBlock=get_block))
+            scrape.backoff_delay = lambda attempt: 0
+            try:
+                with self.assertRaises(RuntimeError):
+                    scrape.producer(block_nums(), txn_queue, price_queue, outfile, blocks_per_part=10, blocks_table=blocks_table)
+            finally:
+                scrape.connect, scrape.backoff_delay = _connect, _backoff
+            blocks_table.close()
+            self.assertEqual(calls.count(2), scrape.MAX_REQUEUES + 1)
+            df = pd.read_csv(scrape.part_path(outfile, 0), sep='\t')
+            self.assertEqual(df['blockNum'].tolist(), [1, 3, 4])
+            self.assertEqual(scrape.scraped_blocks(outfile)[0], {1, 3, 4})
+
+    def test_default_name(self):
+        dt = datetime(2020, 8, 1, tzinfo=timezone.utc)
+        self.assertEqual(scrape.default_name(dt, None, None, None, 5), 'gas_prices_2020-08-01_5%-sampling')
+        self.assertEqual(scrape.default_name(None, None, 100, 200, 5), 'gas_prices_b100_b200_5%-sampling')
+
+    def test_plan(self):
+        p = scrape.plan(1000, nthreads=8, n_endpoints=1, txns_per_block=99)
+        self.assertEqual(p['requests'], 100000)
+        self.assertEqual(scrape.plan(1000, nthreads=8, raw=True)['requests'], 1000)
+        self.assertGreater(p['estimated_time'].total_seconds(), 0)
+        # one thread still gets a consumer
+        self.assertEqual(scrape.plan(1000, nthreads=1)['requests_per_second'], scrape.plan(1000, nthreads=2)['requests_per_second'])
+        with self.assertRaises(SystemExit):
+            scrape.parse_args(['--threads', '1'])
+        # by default, the endpoints' limits are the cap, not the threads
+        self.assertEqual(scrape.n_consumers(scrape.default_threads(2)), 2 * ratelimit.AdaptiveConcurrency().max_limit)
+        self.assertEqual(scrape.plan(1000, nthreads=None, n_endpoints=2)['requests_per_second'], 2 * scrape.RPC_REQUESTS_PER_SECOND)
+
+class FakeWeb3(object):
+    '''Just enough of web3 for fees.get_block_fees.'''
+
+    def __init__(self, block, receipts, block_receipts=True):
+        self.block = block
+        self.receipts = receipts
+        self.block_receipts = block_receipts
+        self.eth = self
+        self.manager = self
+
+    def getBlock(self, block_num, full_transactions=False):
+        return self.block
+
+    def request_blocking(self, method, params):
+        if not self.block_receipts:
+            raise ValueError({'code': -32601, 'message': 'the method eth_getBlockReceipts does not exist'})
+        return self.receipts
+
+class FakeSession(object):
+    '''Answers JSON-RPC batches of eth_getBlockByNumber with synthetic blocks.'''
+
+    def __init__(self):
+        self.batches = []
+
+    def post(self, endpoint, data, headers, timeout):
+        payload = rawrpc.loads(data)
+        self.batches.append(len(payload))
+        responses = [
+            {'jsonrpc': '2.0', 'id': p['id'], 'result': rawrpc.loads(rawrpc.synthetic_block(int(p['params'][0], 16), 5))['result']}
+            for p in payload
+        ]
+        return SimpleNamespace(content=rawrpc.dumps(responses[::-1]), raise_for_status=lambda: None)
+
+class TestRawRPC(unittest.TestCase):
+
+    def test_hex_to_int(self):
+        values = [hex(v) for v in [0, 1, 255, 10**9, 2**63 + 5]]
+        self.assertEqual(rawrpc.hex_to_int(values).tolist(), [0, 1, 255, 10**9, 2**63 + 5])
+
+    def test_parse_blocks(self):
+        results = [rawrpc.loads(rawrpc.synthetic_block(n, n % 4))['result'] for n in range(100, 110)]
+        blocks = rawrpc.parse_blocks(results)
+        self.assertEqual(blocks.number.tolist(), list(range(100, 110)))
+        self.assertEqual(blocks.timestamp.tolist(), [int(r['timestamp'], 16) for r in results])
+        txns = [t for r in results for t in r['transactions']]
+        self.assertEqual(blocks.gas_price.tolist(), [int(t['gasPrice'], 16) for t in txns])
+        self.assertEqual(blocks.txn_block.tolist(), [int(t['blockNumber'], 16) for t in txns])
+        self.assertEqual(blocks.rows()[0], (101, txns[0]['hash'], int(txns[0]['gasPrice'], 16)))
+
+    def test_get_blocks_in_batches(self):
+        session = FakeSession()
+        blocks = rawrpc.get_blocks('http://raw.test', range(50, 95), batch_size=20, session=session)
+        self.assertEqual(session.batches, [20, 20, 5])
+        # responses are put back in request order
+        self.assertEqual(blocks.number.tolist(), list(range(50, 95)))
+        self.assertEqual(len(blocks.gas_price), 45 * 5)
+
+    def test_block_prices(self):
+        prices = rawrpc.get_block_prices('http://raw.test', [7, 3], session=FakeSession())
+        self.assertEqual(sorted(prices), [3, 7])
+        timestamp, rows = prices[3]
+        self.assertEqual(timestamp, 1_600_000_000 + 13 * 3)
+        self.assertEqual([r[0] for r in rows], [3] * 5)
+
+    def test_consumer_batches_blocks(self):
+        """
+        Raw consumers fetch up to BATCH_SIZE queued blocks at once
+        """
+        calls = []
+        def fake_prices(endpoint, block_nums):
+            calls.append(list(block_nums))
+            return {n: (n * 10, [(n, f'0x{n:x}', n)]) for n in block_nums}
+
+        txn_queue, price_queue = queue.Queue(), queue.Queue()
+        for n in range(45):
+            txn_queue.put((n, None, 0))
+        with tempfile.TemporaryDirectory() as dirname:
+            blocks_table = scrape.BlocksTable(os.path.join(dirname, 'blocks.csv'))
+            scrape.PBAR = SimpleNamespace(update=lambda n: None)
+            _prices, rawrpc.get_block_prices = rawrpc.get_block_prices, fake_prices
+            try:
+                threading.Thread(target=scrape.consoomer, daemon=True, args=(0, txn_queue, price_queue), kwargs={
+                    'endpoint': 'http://raw.test', 'blocks_table': blocks_table, 'raw': True}).start()
+                txn_queue.join()
+            finally:
+                rawrpc.get_block_prices = _prices
+            blocks_table.close()
+        self.assertEqual([len(c) for c in calls], [20, 20, 5])
+        self.assertEqual(sorted(price_queue.get()[0] for _ in range(45)), list(range(45)))
+
+    def test_consumer_isolates_bad_blocks(self):
+        """
+        A block that fails doesn't fail the other blocks of its batch
+        """
+        def fake_prices(endpoint, block_nums):
+            if 3 in block_nums:
+                raise ValueError('blocks not found: [3]')
+            return {n: (n * 10, [(n, f'0x{n:x}', n)]) for n in block_nums}
+
+        txn_queue, price_queue = queue.Queue(), queue.Queue()
+        items = [(n, None, scrape.MAX_REQUEUES) for n in range(5)]
+        for _ in items:
+            txn_queue.put(None)
+        with tempfile.TemporaryDirectory() as dirname:
+            blocks_table = scrape.BlocksTable(os.path.join(dirname, 'blocks.csv'))
+            scrape.PBAR = SimpleNamespace(update=lambda n: None)
+            _prices, rawrpc.get_block_prices = rawrpc.get_block_prices, fake_prices
+            try:
+                scrape.consume_raw(0, items, txn_queue, price_queue, 'http://raw.test', blocks_table)
+            finally:
+                rawrpc.get_block_prices = _prices
+            blocks_table.close()
+        self.assertEqual(sorted(price_queue.get()[0] for _ in range(4)), [0, 1, 2, 4])
+        self.assertTrue(price_queue.empty())
+        self.assertEqual(txn_queue.unfinished_tasks, 0)
+
+class TestFees(unittest.TestCase):
+
+    def setUp(self):
+        self.block = {
+            'timestamp': 1630000000,
+            'baseFeePerGas': 100,
+            'transactions': [
+                {'hash': '0x01', 'gasPrice': 150},
+                {'hash': '0x02', 'gasPrice': 130, 'maxFeePerGas': 300, 'maxPriorityFeePerGas': 30},
+            ],
+        }
+        self.receipts = [
+            {'gasUsed': '0x5208', 'effectiveGasPrice': '0x96'},
+            {'gasUsed': '0x5208'},
+        ]
+
+    def test_block_fees(self):
+        ts, rows = fees.get_block_fees(FakeWeb3(self.block, self.receipts), 13000000, 'fake')
+        self.assertEqual(ts, 1630000000)
+        self.assertEqual(rows, [
+            (13000000, '0x01', 150, 150, 50, 100, 21000),
+            (13000000, '0x02', 130, 130, 30, 100, 21000),
+        ])
+
+    def test_falls_back_to_batched_receipts(self):
+        batches = []
+        def fake_batch(endpoint, method, params_list):
+            batches.append((method, params_list))
+            return self.receipts
+        _batch, fees.jsonrpc_batch = fees.jsonrpc_batch, fake_batch
+        try:
+            _, rows = fees.get_block_fees(FakeWeb3(self.block, None, block_receipts=False), 13000000, 'fake-nosupport')
+        finally:
+            fees.jsonrpc_batch = _batch
+        self.assertEqual(batches, [('eth_getTransactionReceipt', [['0x01'], ['0x02']])])
+        self.assertEqual(len(rows), 2)
+
+class FakeChain(object):
+    '''A node whose blocks after `fork` can be replaced, i.e. reorged.'''
+
+    def __init__(self, head):
+        self.head = head
+        self.forked = set()
+        self.requests = []
+
+    def block_hash(self, n):
+        return f"0x{n:x}{'f' if n in self.forked else ''}"
+
+    def make_request(self, method, params):
+        self.requests.append(method)
+        if method == 'eth_blockNumber':
+            return {'result': hex(self.head)}
+        n = int(params[0], 16)
+        return {'result': {'number': hex(n), 'hash': self.block_hash(n), 'parentHash': self.block_hash(n - 1)}}
+
+class TestFinalityCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = cache.RPCCache(os.path.join(self.tmp.name, 'cache'), finality_depth=10, recent_ttl=60)
+        self.chain = FakeChain(head=100)
+        self.request = cache.construct_cache_middleware(self.cache)(self.chain.make_request, None)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp.cleanup()
+
+    def get_block(self, n):
+        return self.request('eth_getBlockByNumber', [hex(n), False])['result']
+
+    def test_only_final_blocks_persisted(self):
+        self.get_block(50)
+        self.get_block(95)
+        self.assertIsNotNone(self.cache.get(cache.cache_key('eth_getBlockByNumber', [hex(50), False])))
+        self.assertIsNone(self.cache.get(cache.cache_key('eth_getBlockByNumber', [hex(95), False])))
+        # both are answered from the cache for now
+        n = len(self.chain.requests)
+        self.get_block(50)
+        self.get_block(95)
+        self.assertEqual(len(self.chain.requests), n)
+
+    def test_recent_blocks_expire(self):
+        self.get_block(95)
+        self.cache.recent = {k: (0,) + entry[1:] for k, entry in self.cache.recent.items()}
+        n = len(self.chain.requests)
+        self.get_block(95)
+        self.assertGreater(len(self.chain.requests), n)
+
+    def test_reorg_drops_recent_blocks(self):
+        self.get_block(95)
+        self.get_block(96)
+        self.chain.forked = {96, 97}
+        # block 97's parent isn't the 96 we've cached anymore
+        self.get_block(97)
+        self.assertEqual(self.get_block(96)['hash'], self.chain.block_hash(96))
+        self.assertEqual(self.get_block(95)['hash'], '0x5f')
+
+class TestNotebookCache(unittest.TestCase):
+
+    def test_only_final_blocks_persisted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            added = []
+            _utils._init_cache(SimpleNamespace(middleware_onion=SimpleNamespace(add=added.append)), os.path.join(tmp, 'api_cache'))
+            request = added[0](FakeChain(head=1000).make_request, None)
+            params = {n: [hex(n), False] for n in [100, 990]}
+            for p in params.values():
+                request('eth_getBlockByNumber', p)
+            db = cache.open_cache(os.path.join(tmp, 'api_cache'))
+            self.assertIsNotNone(db.get(cache.cache_key('eth_getBlockByNumber', params[100])))
+            self.assertIsNone(db.get(cache.cache_key('eth_getBlockByNumber', params[990])))
+            self.assertIsNotNone(db.get_recent(cache.cache_key('eth_getBlockByNumber', params[990])))
+
+class TestEndpointLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = ratelimit.EndpointLimiter('test', rate=1000, max_retries=3)
+        # don't actually sleep between retries
+        self._backoff = ratelimit.backoff_delay
+        ratelimit.backoff_delay = lambda attempt: 0
+
+    def tearDown(self):
+        ratelimit.backoff_delay = self._backoff
+
+    def test_retries_throttled_calls(self):
+        """
+        Throttled calls are retried and shrink the concurrency limit
+        """
+        calls = []
+        def fn():
+            calls.append(1)
+            if len(calls) < 3:
+                return {'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32005, 'message': 'limit exceeded'}}
+            return {'jsonrpc': '2.0', 'id': 1, 'result': '0x1'}
+
+        limit = self.limiter.concurrency.limit
+        self.assertEqual(self.limiter.call(fn)['result'], '0x1')
+        self.assertEqual(len(calls), 3)
+        self.assertLess(self.limiter.concurrency.limit, limit)
+        self.assertEqual(self.limiter.concurrency.inflight, 0)
+
+    def test_retries_throttled_batches(self):
+        """
+        A batch is throttled if any of its responses is
+        """
+        calls = []
+        def fn():
+            calls.append(1)
+            error = {'code': -32005, 'message': 'limit exceeded'} if len(calls) < 2 else None
+            return [{'jsonrpc': '2.0', 'id': 0, 'result': '0x1'},
+                    {'jsonrpc': '2.0', 'id': 1, 'error': error} if error else {'jsonrpc': '2.0', 'id': 1, 'result': '0x2'}]
+
+        limit = self.limiter.concurrency.limit
+        self.assertEqual([r['result'] for r in self.limiter.call_batch(2, fn)], ['0x1', '0x2'])
+        self.assertEqual(len(calls), 2)
+        self.assertLess(self.limiter.concurrency.limit, limit)
+
+    def test_gives_up_after_max_retries(self):
+        def fn():
+            raise requests.exceptions.Timeout()
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.limiter.call(fn)
+
+    def test_does_not_retry_other_errors(self):
+        calls = []
+        def fn():
+            calls.append(1)
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            self.limiter.call(fn)
+        self.assertEqual(len(calls), 1)
+
+def make_dataset(dirname, nblocks=300, first_block=10_000_000, seed=0, nparts=4, jitter=0):
+    '''
+    Write a small fake scrape to `dirname`, in the same format as scrape.py.
+    With `jitter`, txns are written up to that many blocks out of order,
+    like scrape.py's threads do, so consecutive parts share blocks.
+    Returns the full DataFrame (blockNum, txnID, gasPrice, timeStamp).
+    '''
+    rng = np.random.default_rng(seed)
+    blocks = pd.DataFrame({
+        'blockNum': np.arange(first_block, first_block + nblocks),
+        'timeStamp': 1_600_000_000 + np.cumsum(rng.integers(1, 30, nblocks)),
+    })
+    ntxns = rng.integers(0, 40, nblocks)
+    df = pd.DataFrame({'blockNum': np.repeat(blocks['blockNum'].values, ntxns)})
+    df['txnID'] = [f'0x{i:064x}' for i in range(len(df))]
+    df['gasPrice'] = rng.integers(1, 500, len(df)) * 1_000_000_000
+    outfile = os.path.join(dirname, 'gas_prices_2020-08-01_2020-08-02_5%-sampling')
+    order = np.argsort(df['blockNum'].values + rng.uniform(0, jitter, len(df)), kind='stable')
+    for part, idx in enumerate(np.array_split(order, nparts)):
+        df.iloc[idx].to_csv(f'{outfile}_{part}.csv', sep='\t', index=False)
+    blocks.to_csv(os.path.join(dirname, 'blocks_gas_prices_2020-08-01_2020-08-02_5%-sampling.csv'), sep='\t', index=False)
+    return df.merge(blocks, on='blockNum')
+
+class TestResampler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.df = make_dataset(self.tmp.name)
+        self.parts = dataset.find_parts(os.path.join(self.tmp.name, 'gas_prices_*.csv'))
+        self.blocks = dataset.load_block_timestamps(os.path.join(self.tmp.name, 'blocks_*.csv'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_streaming_matches_in_memory(self):
+        """
+        Resampling in small chunks gives the same result as aggregating everything at once
+        """
+        self.assertEqual(len(self.parts), 4)
+        r = resample.Resampler(lateness=0).update(self.parts, self.blocks, chunksize=100)
+        for f in ['1m', '5m', '1h']:
+            expected = resample.aggregate(self.df, resample.FREQS[f])
+            pd.testing.assert_frame_equal(r.get(f), expected, check_dtype=False)
+
+    def test_incremental_update(self):
+        r = resample.Resampler(lateness=0).update(self.parts[:2], self.blocks, chunksize=100)
+        path = os.path.join(self.tmp.name, 'state.pkl')
+        r.save(path)
+        r = resample.Resampler.load(path).update(self.parts, self.blocks, chunksize=100)
+        expected = resample.aggregate(self.df, resample.FREQS['5m'])
+        pd.testing.assert_frame_equal(r.get('5m'), expected, check_dtype=False)
+        self.assertEqual(r.late_txns, {f: 0 for f in r.freqs})
+
+    def test_many_parts(self):
+        """
+        Parts are read in block order, not name order (part _10 after part _2)
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            df = make_dataset(tmp, nblocks=600, nparts=24, jitter=3)
+            parts = dataset.find_parts(os.path.join(tmp, 'gas_prices_*.csv'))
+            self.assertEqual([int(p.rsplit('_', 1)[1].split('.')[0]) for p in parts], list(range(24)))
+            blocks = dataset.load_block_timestamps(os.path.join(tmp, 'blocks_*.csv'))
+            r = resample.Resampler(lateness=0).update(parts, blocks, chunksize=100)
+            for f in ['1m', '5m', '1h', '1d']:
+                expected = resample.aggregate(df, resample.FREQS[f])
+                pd.testing.assert_frame_equal(r.get(f), expected, check_dtype=False)
+            self.assertEqual(r.late_txns, {f: 0 for f in r.freqs})
+
+            # touched files aren't ingested again
+            os.utime(parts[5])
+            r.update(parts, blocks, chunksize=100)
+            self.assertEqual(r.get('1d')['count'].sum(), len(df))
+
+    def test_appended_part(self):
+        """
+        Only the rows appended to an already ingested part are ingested
+        """
+        r = resample.Resampler(lateness=0)
+        with open(self.parts[-1]) as f:
+            lines = f.readlines()
+        with open(self.parts[-1], 'w') as f:
+            f.writelines(lines[:-10])
+        r.update(self.parts, self.blocks, chunksize=100)
+        with open(self.parts[-1], 'a') as f:
+            f.writelines(lines[-10:])
+        os.utime(self.parts[-1], (time.time() + 5, time.time() + 5))
+        r.update(self.parts, self.blocks, chunksize=100)
+        expected = resample.aggregate(self.df, resample.FREQS['1h'])
+        pd.testing.assert_frame_equal(r.get('1h'), expected, check_dtype=False)
+        # touching it again adds nothing
+        os.utime(self.parts[-1], (time.time() + 10, time.time() + 10))
+        r.update(self.parts, self.blocks, chunksize=100)
+        pd.testing.assert_frame_equal(r.get('1h'), expected, check_dtype=False)
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.blocks = pd.Series([100, 113, 130, 150, 152, 175, 240], index=range(10, 17), name='timeStamp')
+
+    def test_resolve_matches_linear_scan(self):
+        """
+        Vectorized alignment matches a naive scan over blocks
+        """
+        wake_up_times = _schedule.poisson_schedule(90, 250, mean_interval=5, seed=1)
+        resolved = _schedule.resolve(wake_up_times, self.blocks, lag=3, window=60, delay=10)
+        block_items = list(self.blocks.items())
+        n = 0
+        for t in wake_up_times:
+            ts = t + 3
+            before = [b for b, bts in block_items if bts <= ts]
+            after = [b for b, bts in block_items if bts > ts]
+            if not before or not after:
+                continue
+            row = resolved.iloc[n]
+            n += 1
+            self.assertEqual(row.current_block, before[-1])
+            self.assertEqual(row.next_block, after[0])
+            window = [b for b, bts in block_items if ts + 10 < bts <= ts + 60]
+            self.assertEqual(list(self.blocks.index[row.window_lo:row.window_hi]), window)
+        self.assertEqual(n, len(resolved))
+
+    def test_explode_windows(self):
+        resolved = _schedule.resolve([105, 140], self.blocks, lag=0, window=60, delay=0)
+        df = _schedule.explode_windows(resolved, self.blocks)
+        self.assertEqual(df['blockNum'].tolist(), [11, 12, 13, 14, 13, 14, 15])
+        self.assertEqual(df['confirmation_block_num'].tolist(), [1, 2, 3, 4, 1, 2, 3])
+        self.assertEqual(df['confirmation_block_seconds'].tolist()[:2], [8, 25])
+
+    def test_schedules_within_range(self):
+        for schedule in [
+                _schedule.fixed_schedule('2020-08-01', '2020-08-02'),
+                _schedule.jittered_schedule('2020-08-01', '2020-08-02', seed=0),
+                _schedule.poisson_schedule('2020-08-01', '2020-08-02', seed=0)]:
+            self.assertTrue(np.all(np.diff(schedule) >= 0))
+            self.assertGreater(len(schedule), 1000)
+            self.assertGreaterEqual(schedule[0], 1596240000 - 10)
+            self.assertLess(schedule[-1], 1596326400 + 10)
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.blocks = pd.DataFrame({
+            'timeStamp': 1000 + np.cumsum(rng.integers(1, 30, 500)),
+            'minGasPrice': rng.lognormal(3, 0.5, 500),
+        }, index=np.arange(100, 600))
+        self.wake_up_times = rng.uniform(1000, self.blocks['timeStamp'].iloc[-1], 300)
+        self.strategies = {'fixed': lambda b: np.full(len(b), 25.0), 'by_block': lambda b: (b % 50).astype(float)}
+
+    def test_matches_naive_scan(self):
+        """
+        Without a capacity limit, each txn is included in the first block that would take it
+        """
+        df, _ = _replay.replay(self.blocks, self.wake_up_times, self.strategies, lag=3, delay=10, timeout=60)
+        ts = self.blocks['timeStamp']
+        in_range = (self.wake_up_times + 3 >= ts.iloc[0]) & (self.wake_up_times + 63 <= ts.iloc[-1])
+        self.assertEqual(len(df), 2 * in_range.sum())
+        self.assertGreater(df['mined?'].sum(), 0)
+        for row in df.to_dict('records'):
+            window = self.blocks[(ts > row['submit_ts'] + 10) & (ts <= row['submit_ts'] + 60)]
+            takers = window[window['minGasPrice'] < row['gasPrice']]
+            self.assertEqual(row['mined?'], len(takers) > 0)
+            if len(takers):
+                self.assertEqual(row['confirmation_block'], takers.index[0])
+                self.assertEqual(row['confirmation_block_num'], list(window.index).index(takers.index[0]) + 1)
+
+    def test_capacity(self):
+        _, uncapped = _replay.replay(self.blocks, self.wake_up_times, self.strategies, lag=(1, 5), seed=0)
+        df, capped = _replay.replay(self.blocks, self.wake_up_times, self.strategies, lag=(1, 5), capacity=1, seed=0)
+        self.assertLessEqual(capped['included'].max(), 1)
+        self.assertEqual(capped['included'].sum(), df['mined?'].sum())
+        self.assertGreaterEqual(capped['pending'].sum(), uncapped['pending'].sum())
+
+    def test_unpriced_txns(self):
+        """
+        Txns a strategy can't price aren't mined, and don't keep others from being mined
+        """
+        strategies = {
+            'fixed': self.strategies['fixed'],
+            'gappy': lambda b: np.where(b % 3 == 0, np.nan, 25.0),
+        }
+        df, _ = _replay.replay(self.blocks, self.wake_up_times, strategies, lag=3, delay=10, timeout=60)
+        fixed, gappy = df[df['method'] == 'fixed'], df[df['method'] == 'gappy']
+        unpriced = gappy['gasPrice'].isna().to_numpy()
+        self.assertTrue(unpriced.any())
+        self.assertFalse(gappy['mined?'][unpriced].any())
+        self.assertGreater(fixed['mined?'].sum(), 0)
+        np.testing.assert_array_equal(gappy['mined?'].to_numpy()[~unpriced], fixed['mined?'].to_numpy()[~unpriced])
+
+class FakeEth(object):
+    '''Blocks with gas prices 1..n, n = block number % 5'''
+
+    def __init__(self, failing=()):
+        self.calls = []
+        # block -> number of calls that fail
+        self.failing = dict(failing)
+
+    def getBlock(self, block_num, full_transactions=False):
+        assert full_transactions
+        self.calls.append(block_num)
+        if self.calls.count(block_num) <= self.failing.get(block_num, 0):
+            raise ValueError('timeout')
+        txns = [
+            SimpleNamespace(hash=bytes([block_num % 256, i]), gasPrice=i + 1)
+            for i in range(block_num % 5)
+        ]
+        return SimpleNamespace(number=block_num, transactions=txns)
+
+class TestPercentiles(unittest.TestCase):
+
+    def setUp(self):
+        self.eth = FakeEth()
+        _utils.configure()._w3 = SimpleNamespace(eth=self.eth)
+        self.df_mined = pd.DataFrame({
+            'hash': ['0x1', '0x2', '0x3'],
+            'method': ['a', 'b', 'b'],
+            'usedGasPrice': [2, 2, 2],
+            'confirmations': [1, 2, 0],
+            'mined_block': [13, 24, 34],
+            'unmined_blocks': [[11, 12], [21, 22, 23], []],
+        })
+        self.df_hist = pd.DataFrame({'blockNum': [11, 11, 13], 'txnHash': ['0xa', '0xb', '0xc'], 'gasPrice': [1, 5, 9]})
+
+    def tearDown(self):
+        _utils.configure()
+
+    def test_missing_blocks_fetched_once(self):
+        df = _utils.get_percentile_df(self.df_mined, self.df_hist)
+        self.assertEqual(sorted(self.eth.calls), [12, 21, 22, 23, 24, 34])
+        unmined = df[~df['mined?']].sort_values('percentile')
+        # block 11 from history, the rest fetched
+        self.assertEqual(unmined['percentile'].tolist(), [50, 66, 100, 100, 100])
+        mined = df[df['mined?']]
+        self.assertEqual(mined['percentile'].tolist(), [50])
+
+    def test_fill_missing_blocks(self):
+        df_hist = _utils.fill_missing_blocks(self.df_mined, self.df_hist, nthreads=4)
+        self.assertEqual(sorted(df_hist['blockNum'].unique()), [11, 12, 13, 21, 22, 23, 24, 34])
+        self.assertTrue(df_hist['blockNum'].is_monotonic_increasing)
+        self.eth.calls.clear()
+        _utils.get_percentile_df(self.df_mined, df_hist)
+        self.assertEqual(self.eth.calls, [])
+
+    def test_failed_blocks(self):
+        """
+        Blocks that fail to fetch are retried, and raise rather than becoming NaN percentiles
+        """
+        self.eth.failing = {12: 1}
+        df = _utils.get_percentile_df(self.df_mined, self.df_hist)
+        self.assertEqual(self.eth.calls.count(12), 2)
+        self.assertEqual(df['percentile'].isna().sum(), 0)
+
+        self.eth.calls.clear()
+        self.eth.failing = {21: 10}
+        with self.assertRaises(_utils.BlocksNotFetched) as ctx:
+            _utils.get_percentile_df(self.df_mined, self.df_hist)
+        self.assertEqual(ctx.exception.blocks, [21])
+        self.assertEqual(self.eth.calls.count(21), 3)
+
+class TestLiveTestTail(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'txes_recommended.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_half_written_line(self):
+        """
+        A record still being written is only read once it's complete
+        """
+        tail = _utils.LiveTestTail(pattern=os.path.join(self.tmp.name, 'txes_*.jsonl'))
+        with open(self.path, 'w') as f:
+            f.write('{"submitBlockNumber": 1, "hash": "0x1"}\n{"submitBlockNumber": 2, "ha')
+        df = tail.read()
+        self.assertEqual(df['hash'].tolist(), ['0x1'])
+        self.assertEqual(df['method'].tolist(), ['recommended'])
+
+        with open(self.path, 'a') as f:
+            f.write('sh": "0x2"}\n')
+        df = tail.read()
+        self.assertEqual(df['hash'].tolist(), ['0x2'])
+        self.assertEqual(df['submitBlockNumber'].tolist(), [2])
+        self.assertTrue(tail.read().empty)
+
+    def test_int_columns(self):
+        """
+        Prices logged as strings become Int64, missing values NA
+        """
+        records = [
+            {'usedGasPrice': '1234567890123456789', 'confirmBlockNumber': 5},
+            {'usedGasPrice': '42'},
+        ]
+        df = _utils._records_to_df(records, ['a', 'b'])
+        self.assertEqual(df['usedGasPrice'].dtype, pd.Int64Dtype())
+        self.assertEqual(df['usedGasPrice'].tolist(), [1234567890123456789, 42])
+        self.assertEqual(df['confirmBlockNumber'].dtype, pd.Int64Dtype())
+        self.assertTrue(pd.isna(df['confirmBlockNumber'][1]))
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def test_relative_error(self):
+        rng = np.random.default_rng(0)
+        values = rng.lognormal(23, 1, 100000).round()
+        values[:50] = 0
+        s = sketch.QuantileSketch(0.01).add(values[:30000]).merge(sketch.QuantileSketch(0.01).add(values[30000:]))
+        self.assertEqual(s.count, len(values))
+        for q in [0.001, 0.1, 0.5, 0.9, 0.999]:
+            self.assertAlmostEqual(s.quantile(q) / np.quantile(values, q), 1, delta=0.02)
+        self.assertEqual(s.quantile(0), 0)
+        self.assertEqual(s.quantile(1), values.max())
+        self.assertAlmostEqual(s.rank(np.quantile(values, 0.3)), 0.3, delta=0.01)
+
+    def test_sketch_table(self):
+        """
+        Per block sketches agree with single sketches, whether built at once or from parts
+        """
+        with tempfile.TemporaryDirectory() as dirname:
+            df = make_dataset(dirname, nblocks=100)
+        table = sketch.SketchTable.from_frame(df)
+        parts = sketch.SketchTable.concat([sketch.SketchTable.from_frame(df[i::3]) for i in range(3)])
+        for q in [0, 0.1, 0.5, 0.9, 1]:
+            np.testing.assert_array_equal(table.quantile(q), parts.quantile(q))
+        b = table.keys[10]
+        expected = sketch.QuantileSketch().add(df[df['blockNum'] == b]['gasPrice'].to_numpy())
+        self.assertEqual(table.quantile(0.5, keys=[b])[0], expected.quantile(0.5))
+        self.assertAlmostEqual(table.rank(100e9, keys=[b])[0], expected.rank(100e9))
+        exact = df.groupby('blockNum')['gasPrice'].quantile(0.5, interpolation='lower').to_numpy()
+        np.testing.assert_allclose(table.percentile(50), exact, rtol=0.02)
+
+        hourly = sketch.time_buckets(table, df.groupby('blockNum')['timeStamp'].first(), 3600)
+        self.assertEqual(hourly.totals.sum(), len(df))
+        self.assertTrue((hourly.keys % 3600 == 0).all())
+
+class TestAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.df = make_dataset(self.tmp.name, nblocks=300)
+        # a second, overlapping scrape with some of the same txns
+        other = self.df[self.df['blockNum'] % 3 == 0][['blockNum', 'txnID', 'gasPrice']]
+        other.to_csv(os.path.join(self.tmp.name, 'gas_prices_other_0.csv'), sep='\t', index=False)
+        self.parts = dataset.find_parts(os.path.join(self.tmp.name, 'gas_prices_*.csv'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_ordered_chunks(self):
+        """
+        Chunks are block-ordered, deduplicated and never split a block
+        """
+        chunks = list(dataset.iter_ordered_chunks(self.parts, chunksize=500))
+        self.assertGreater(len(chunks), 1)
+        df = pd.concat(chunks, ignore_index=True)
+        self.assertTrue(df['blockNum'].is_monotonic_increasing)
+        self.assertEqual(len(df), len(self.df))
+        blocks = [set(c['blockNum']) for c in chunks]
+        for a, b in zip(blocks, blocks[1:]):
+            self.assertFalse(a & b)
+
+    def test_dedup_by_txn(self):
+        """
+        Only the same txn is a duplicate, not another txn with the same price
+        """
+        paths = [os.path.join(self.tmp.name, f'dup_{i}.csv') for i in range(2)]
+        with open(paths[0], 'w') as f:
+            f.write('blockNum\ttxnID\tgasPrice\n1\t0xa\t5\n1\t0xb\t5\n2\t0xc\t7\n2\t0xd\t7\n')
+        with open(paths[1], 'w') as f:
+            f.write('blockNum\ttxnID\tgasPrice\n2\t0xd\t7\n3\t0xe\t7\n')
+        df = pd.concat(dataset.iter_ordered_chunks(paths, usecols=['blockNum', 'gasPrice']))
+        self.assertEqual(list(df.columns), ['blockNum', 'gasPrice'])
+        self.assertEqual(df['blockNum'].tolist(), [1, 1, 2, 2, 3])
+
+    def test_run(self):
+        results = analysis.run(self.parts, {
+            'count': analysis.Count(),
+            'blocks': analysis.BlockSummary(),
+            'quantiles': analysis.Quantiles(),
+        }, chunksize=500)
+        self.assertEqual(results['count'], {'txns': len(self.df), 'blocks': self.df['blockNum'].nunique()})
+        expected = self.df.groupby('blockNum')['gasPrice'].median()
+        pd.testing.assert_series_equal(results['blocks']['p50'], expected, check_names=False)
+        self.assertAlmostEqual(results['quantiles'].quantile(0.5) / self.df['gasPrice'].median(), 1, delta=0.02)
+
+    def test_run_parallel(self):
+        aggregations = {'count': analysis.Count(), 'blocks': analysis.BlockSummary()}
+        serial = analysis.run(self.parts, copy.deepcopy(aggregations))
+        parallel = analysis.run_parallel(self.parts, aggregations, processes=2)
+        self.assertEqual(serial['count'], parallel['count'])
+        pd.testing.assert_frame_equal(serial['blocks'], parallel['blocks'])
+
+class TestMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = memo.ResultCache(os.path.join(self.tmp.name, 'memo'))
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def sim(self, methods):
+        self.calls.append(list(methods))
+        return pd.DataFrame({
+            'method': np.repeat(methods, 3),
+            'gasPrice': np.arange(3 * len(methods), dtype=float),
+            'confirmation_block_num': pd.array([1, None, 2] * len(methods), dtype='Int64'),
+        })
+
+    def test_per_strategy(self):
+        key = memo.make_key('data', np.arange(10), memo.code_version(memo.make_key))
+        first = memo.memoize_per_strategy(self.cache, key, ['a', 'b'], self.sim)
+        again = memo.memoize_per_strategy(memo.ResultCache(self.cache.directory), key, ['a', 'b'], self.sim)
+        pd.testing.assert_frame_equal(first, again)
+        memo.memoize_per_strategy(self.cache, key, ['b', 'c'], self.sim)
+        self.assertEqual(self.calls, [['a', 'b'], ['c']])
+        # a different schedule is a different key
+        memo.memoize_per_strategy(self.cache, memo.make_key('data', np.arange(11)), ['a'], self.sim)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_strategy_specs(self):
+        """
+        Changing a strategy's parameters under the same name recomputes it
+        """
+        key = memo.make_key('data')
+        memo.memoize_per_strategy(self.cache, key, {'boosted': {'boost': 1.5}, 'a': None}, self.sim)
+        memo.memoize_per_strategy(self.cache, key, {'boosted': {'boost': 1.5}}, self.sim)
+        memo.memoize_per_strategy(self.cache, key, {'boosted': {'boost': 1.6}, 'a': None}, self.sim)
+        self.assertEqual(self.calls, [['boosted', 'a'], ['boosted']])
+
+    def test_unstable_keys(self):
+        with self.assertRaises(TypeError):
+            memo.make_key(lambda: 1)
+        self.assertEqual(memo.make_key(pd.Timestamp('2020-08-01')), memo.make_key(pd.Timestamp('2020-08-01')))
+
+    def test_lru_eviction(self):
+        for k in 'abc':
+            self.cache.put(k, self.sim(['x'] * 1000))
+        self.cache.max_bytes = self.cache.size() - 1
+        self.cache.get('a')
+        self.cache.put('d', self.sim(['x']))
+        self.assertNotIn('b', self.cache)
+        self.assertIn('a', self.cache)
+        self.assertLessEqual(self.cache.size(), self.cache.max_bytes)
+
+    def test_shared_directory(self):
+        """
+        Instances on the same directory see and evict each other's results
+        """
+        other = memo.ResultCache(self.cache.directory)
+        self.cache.put('a', self.sim(['x'] * 1000))
+        other.put('b', self.sim(['x'] * 1000))
+        self.assertIn('b', self.cache)
+        pd.testing.assert_frame_equal(self.cache.get('b'), self.sim(['x'] * 1000))
+        self.cache.max_bytes = other.max_bytes = self.cache.size() - 1
+        self.cache.put('c', self.sim(['x'] * 1000))
+        other.put('d', self.sim(['x'] * 1000))
+        self.assertLessEqual(self.cache.size(), self.cache.max_bytes)
+        self.assertNotIn('a', other)
+        self.assertIn('d', self.cache)
+
+    def test_fingerprint(self):
+        make_dataset(self.tmp.name, nblocks=50)
+        parts = dataset.find_parts(os.path.join(self.tmp.name, 'gas_prices_*.csv'))
+        before = dataset.fingerprint(parts)
+        self.assertEqual(before, dataset.fingerprint(parts))
+        with open(parts[0], 'a') as f:
+            f.write('1\t0x0\t1\n')
+        self.assertNotEqual(before, dataset.fingerprint(parts))
+        # files aren't read
+        _iter_chunks, dataset.iter_chunks = dataset.iter_chunks, None
+        try:
+            dataset.fingerprint(parts)
+        finally:
+            dataset.iter_chunks = _iter_chunks
+
+class TestInclusionModel(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.df = make_dataset(self.tmp.name, nblocks=200)
+        # leave some gaps, like sampled scrapes
+        self.df = self.df[self.df['blockNum'] % 7 != 0]
+        self.model = inclusion.InclusionModel.fit([self.df], max_k=3)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_percentile_table_matches_row_wise(self):
+        """
+        Precomputed odds match the row-wise computation from gas-price-predictions.ipynb
+        """
+        mins = self.df.groupby('blockNum')['gasPrice'].min()
+        hits, n = 0, 0
+        for b, prices in self.df.groupby('blockNum')['gasPrice']:
+            if b + 1 not in mins.index:
+                continue
+            n += 1
+            hits += np.percentile(prices, 50) > mins.loc[b + 1]
+        self.assertAlmostEqual(float(self.model.p_percentile(50, k=1)), hits / n, places=5)
+
+    def test_price_table_is_monotonic(self):
+        for k in range(1, 4):
+            table = self.model.price_table[k - 1]
+            self.assertTrue(np.all(np.diff(table) >= 0))
+        # more blocks, better odds
+        self.assertTrue(np.all(self.model.price_table[1] >= self.model.price_table[0] - 1e-6))
+        self.assertEqual(self.model.p_price(0), 0)
+        self.assertEqual(self.model.p_price(10**20), 1)
+
+    def test_chunked_fit_and_save(self):
+        parts = dataset.find_parts(os.path.join(self.tmp.name, 'gas_prices_*.csv'))
+        full = inclusion.InclusionModel.fit(dataset.iter_ordered_chunks(parts, chunksize=10**6), max_k=3)
+        chunked = inclusion.InclusionModel.fit(dataset.iter_ordered_chunks(parts, chunksize=150), max_k=3)
+        np.testing.assert_array_equal(full.pct_hits, chunked.pct_hits)
+        np.testing.assert_array_equal(full.min_hist, chunked.min_hist)
+        path = os.path.join(self.tmp.name, 'inclusion.npz')
+        chunked.save(path)
+        loaded = inclusion.InclusionModel.load(path)
+        np.testing.assert_array_equal(loaded.price_table, full.price_table)
+
+    def test_interleaved_parts(self):
+        """
+        Blocks shared by consecutive parts are only counted once
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            df = make_dataset(tmp, nblocks=200, nparts=12, jitter=4)
+            parts = dataset.find_parts(os.path.join(tmp, 'gas_prices_*.csv'))
+            full = inclusion.InclusionModel.fit([df], max_k=3)
+            chunked = inclusion.InclusionModel.fit(dataset.iter_ordered_chunks(parts, chunksize=100), max_k=3)
+            np.testing.assert_array_equal(chunked.n_blocks, full.n_blocks)
+            np.testing.assert_array_equal(chunked.min_hist, full.min_hist)
+            np.testing.assert_array_equal(chunked.pct_hits, full.pct_hits)
+
 if __name__ == '__main__':
     unittest.main()
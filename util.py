@@ -1,15 +1,14 @@
 import time
 import threading
 import warnings
-from web3 import Web3
 
 from config import (
+    FINALITY_DEPTH,
     NODE_IP_ADDR,
     INFURA_PROVIDER
 )
-
-if not NODE_IP_ADDR:
-    warnings.warn("Address of Ethereum node is missing.")
+from cache import construct_cache_middleware, open_cache
+from ratelimit import construct_rate_limit_middleware, get_limiter
 
 class LockedIterator(object):
     # from: https://stackoverflow.com/questions/1131430/are-generators-threadsafe
@@ -26,15 +25,34 @@ class LockedIterator(object):
         finally:
             self.lock.release()
 
-def connect():
-    return Web3(Web3.HTTPProvider(NODE_IP_ADDR))
+def connect(endpoint=NODE_IP_ADDR, cache_path=None):
+    '''
+    Connect to `endpoint`; with `cache_path`, responses that never change
+    are cached on disk (see cache.py).
+    '''
+    # web3 is slow to import; only pay for it when we actually connect
+    from web3 import Web3
+
+    if not endpoint:
+        warnings.warn("Address of Ethereum node is missing.")
+
+    web3 = Web3(Web3.HTTPProvider(endpoint))
+    # all connections to the same endpoint share one rate limiter
+    web3.middleware_onion.add(construct_rate_limit_middleware(get_limiter(endpoint)))
+    if cache_path:
+        # outermost, so cache hits don't count against the rate limit
+        web3.middleware_onion.add(construct_cache_middleware(open_cache(cache_path)))
+    return web3
     #return Web3(Web3.WebsocketProvider(INFURA_PROVIDER))
 
-def get_first_eth_block_at(ts):
+def get_first_eth_block_at(ts, endpoint=NODE_IP_ADDR):
     '''
     Return the first Ethereum block with timestamp less than or equal to timestamp ts.
+
+    Only final blocks (at least FINALITY_DEPTH blocks deep) are considered;
+    for a more recent `ts` the most recent final block is returned.
     '''
-    web3 = connect()
+    web3 = connect(endpoint)
 
     current_time = time.time()
     latest_block = web3.eth.getBlock('latest')
@@ -67,12 +85,13 @@ def get_first_eth_block_at(ts):
     # using 36 instead of 24 to have a buffer than ensures `block24` timestamp >= `ts`
     hours_ahead = 36
     block_num = first_block['number'] + hours_ahead * seconds_in_day // block_time
-    # sometimes latest block will return an error when using its number in `getBlock`
-    # probably due to general asynchrony in the network, hence buffer
-    buffer_ = 10
-    block_num = min(web3.eth.getBlock('latest')['number'] - buffer_, block_num)
+    # blocks near the head can still be reorged (and `getBlock` on the very
+    # latest ones sometimes fails), so stay below the finality depth
+    block_num = min(web3.eth.getBlock('latest')['number'] - FINALITY_DEPTH, block_num)
     block24 = web3.eth.getBlock(block_num)
-    assert block24['timestamp'] > ts
+    if block24['timestamp'] <= ts:
+        # `ts` is more recent than the last final block
+        return block24
 
     return __binary_search(web3, ts, first_block, block24)
 